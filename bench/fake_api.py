@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+'''stand-in for the tester API (the "queue", "version" and "results" templates), serving a synthetic queue of
+distributions and accepting the results - so that the client can be benchmarked without touching the live server'''
+
+import argparse
+import BaseHTTPServer
+import gzip
+import hashlib
+import json
+import SocketServer
+import StringIO
+import threading
+import time
+import urlparse
+import uuid
+
+TEMPLATES = {'queue' : '/queue/{name}/{version}', 'version' : '/version/{name}/{version}', 'results' : '/results'}
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class FakeApi(threading.Thread):
+	'''the fake API server (in a background thread) - the queue has the requested number of distributions (with the
+	given share of them requiring a newer PostgreSQL), and it counts the requests and keeps the submitted results'''
+
+	def __init__(self, distributions=100, unmet=0.0, port=0, host='127.0.0.1'):
+		super(FakeApi, self).__init__(name='fake-api')
+		self.daemon = True
+
+		self._lock = threading.Lock()
+		self.requests = {}
+		self.results = []
+
+		queue = [{'name' : 'bench%(id)04d' % {'id' : i}, 'version' : '1.0.%(id)d' % {'id' : i}} for i in range(distributions)]
+		self._queue = json.dumps(queue)
+		self._etag = '"%(hash)s"' % {'hash' : hashlib.sha1(self._queue).hexdigest()}
+
+		# the first distributions (a deterministic share) need a PostgreSQL version no one has
+		self._unmet = set([d['name'] for d in queue[:int(unmet * distributions)]])
+
+		api = self
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+			protocol_version = 'HTTP/1.1'
+
+			def _send(self, status, body, headers=None):
+
+				self.send_response(status)
+				for (k, v) in (headers or {}).items():
+					self.send_header(k, v)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def do_GET(self):
+
+				url = urlparse.urlparse(self.path)
+				parts = url.path.strip('/').split('/')
+
+				if url.path.strip('/') == '':
+					api._count('templates')
+					self._send(200, json.dumps(TEMPLATES))
+
+				elif parts[0] == 'queue':
+					api._count('queue')
+					if self.headers.get('If-None-Match') == api._etag:
+						self._send(304, '', {'ETag' : api._etag})
+					else:
+						self._send(200, api._queue, {'ETag' : api._etag})
+
+				elif parts[0] == 'version':
+					api._count('version')
+					prereqs = (['>= 99.0.0'] if parts[1] in api._unmet else ['>= 8.2.0'])
+					self._send(200, json.dumps({'name' : parts[1], 'version' : parts[2], 'status' : 'stable', 'prereqs' : prereqs}))
+
+				elif parts[0] == 'results':
+					# nothing tested yet
+					api._count('tested')
+					self._send(200, json.dumps([]))
+
+				else:
+					self._send(404, json.dumps({'error' : 'not found'}))
+
+			def do_POST(self):
+
+				body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+				if self.headers.get('Content-Encoding') == 'gzip':
+					body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+
+				result = json.loads(body)
+				result['received'] = time.time()
+
+				api._count('results')
+
+				with api._lock:
+					api.results.append(result)
+
+				self._send(200, json.dumps({'uuid' : result.get('uuid', str(uuid.uuid4()))}))
+
+			def log_message(self, format, *args):
+				pass
+
+		self._server = ThreadingServer((host, port), Handler)
+		self.port = self._server.server_address[1]
+
+	def _count(self, endpoint):
+
+		with self._lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+	def run(self):
+		self._server.serve_forever()
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='fake tester API')
+	parser.add_argument('--port', dest='port', type=int, default=8080, help='port to listen on (default: 8080)')
+	parser.add_argument('--distributions', dest='distributions', type=int, default=100, help='number of queued distributions (default: 100)')
+	parser.add_argument('--unmet', dest='unmet', type=float, default=0.0, help='share of distributions with unmet prerequisities (default: 0)')
+	args = parser.parse_args()
+
+	api = FakeApi(distributions=args.distributions, unmet=args.unmet, port=args.port)
+	api.start()
+
+	print 'fake API listening on 127.0.0.1:%(port)d (Ctrl-C to stop)' % {'port' : api.port}
+
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		print 'requests: %(requests)s, results: %(results)d' % {'requests' : json.dumps(api.requests), 'results' : len(api.results)}
+		api.stop()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''benchmark of the client itself - runs run-tests.py against the fake tester API (see fake_api.py), with stub
+pgxnclient and PostgreSQL tools (see stubs.py) sleeping for a configured time in each phase, and reports throughput,
+overhead of each phase (measured duration minus the configured one), peak memory and number of API calls'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+
+sys.path.append(BENCH)
+
+from fake_api import FakeApi
+from stubs import write_stubs
+
+PHASES = ['install', 'load', 'check']
+
+def stats(values):
+	'(mean, max) of the values, (0, 0) if there are none'
+
+	if not values:
+		return (0.0, 0.0)
+
+	return (sum(values) / float(len(values)), max(values))
+
+def run(args, workdir):
+	'''runs the client against the fake API, returns (duration in seconds, peak RSS in MB, return value, API requests,
+	submitted results)'''
+
+	api = FakeApi(distributions=args.distributions, unmet=args.unmet)
+	api.start()
+
+	bindir = os.path.join(workdir, 'pg', 'bin')
+	write_stubs(bindir)
+
+	for d in ['tmp', 'pg/share/extension']:
+		os.makedirs(os.path.join(workdir, d))
+
+	env = dict(os.environ)
+	env.update({'PATH' : os.pathsep.join([bindir, env.get('PATH', '')]), 'TMPDIR' : os.path.join(workdir, 'tmp'),
+				'BENCH_ROOT' : os.path.join(workdir, 'pg'), 'BENCH_INSTALL_MS' : str(args.install_ms),
+				'BENCH_LOAD_MS' : str(args.load_ms), 'BENCH_CHECK_MS' : str(args.check_ms), 'BENCH_LOG_BYTES' : str(args.log_bytes),
+				'BENCH_DIFF_BYTES' : str(args.diff_bytes), 'BENCH_FAIL' : str(args.fail), 'BENCH_HANG' : str(args.hang),
+				'BENCH_DEPS' : str(args.deps)})
+
+	command = [sys.executable, os.path.join(ROOT, 'run-tests.py'), '--name', 'bench', '--secret', 'secret',
+			   '--api', '127.0.0.1:%(port)d' % {'port' : api.port}, '--pg-config', os.path.join(bindir, 'pg_config'),
+			   '--jobs', str(args.jobs), '--data-dir', os.path.join(workdir, 'data'), '--log-dir', os.path.join(workdir, 'logs'),
+			   '--cache-dir', os.path.join(workdir, 'cache'), '--spool-dir', os.path.join(workdir, 'spool')] + args.extra.split()
+
+	start = time.time()
+
+	# run-tests.py finds its modules relative to the working directory
+	with open(os.path.join(workdir, 'client.log'), 'w') as log:
+		process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=log)
+		(pid, status, rusage) = os.wait4(process.pid, 0)
+
+	duration = time.time() - start
+
+	api.stop()
+
+	return (duration, rusage.ru_maxrss / 1024.0, os.WEXITSTATUS(status), api.requests, api.results)
+
+def report(args, duration, rss, retval, requests, results):
+
+	print 'client finished in %(duration).1f s (return value %(retval)d), peak RSS %(rss).1f MB' % {'duration' : duration, 'retval' : retval, 'rss' : rss}
+	print
+
+	print 'tests submitted: %(tests)d of %(queued)d queued (%(unmet)d with unmet prerequisities)' % {'tests' : len(results), 'queued' : args.distributions, 'unmet' : int(args.unmet * args.distributions)}
+	outcomes = {}
+	for r in results:
+		outcome = ('%(install)s/%(load)s/%(check)s' % r)
+		outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+	print 'results (install/load/check): %(outcomes)s' % {'outcomes' : json.dumps(outcomes, sort_keys=True)}
+	print 'throughput: %(rate).0f tests/hour (%(jobs)d jobs)' % {'rate' : 3600 * len(results) / max(duration, 0.001), 'jobs' : args.jobs}
+
+	# the best the client could do - all the phases running back to back in all the workers
+	expected = (args.install_ms + args.load_ms + args.check_ms) / 1000.0
+	ideal = 3600 * args.jobs / max(expected, 0.001)
+	print 'ideal throughput: %(rate).0f tests/hour (efficiency %(eff).1f%%)' % {'rate' : ideal, 'eff' : 100.0 * (3600 * len(results) / max(duration, 0.001)) / ideal}
+	print
+
+	print '%-10s %14s %14s %8s' % ('phase', 'overhead (ms)', 'max (ms)', 'tests')
+
+	for phase in PHASES:
+		configured = getattr(args, phase + '_ms')
+		overheads = [r[phase + '_duration'] - configured for r in results if r[phase] != 'unknown']
+		(mean, maximum) = stats(overheads)
+		print '%-10s %14.1f %14.1f %8d' % (phase, mean, maximum, len(overheads))
+
+	print
+
+	print 'API requests: %(requests)s (%(total)d total, %(per)0.1f per test)' % {'requests' : json.dumps(requests, sort_keys=True), 'total' : sum(requests.values()), 'per' : sum(requests.values()) / float(max(len(results), 1))}
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='benchmark of the client (fake API, stub pgxnclient / PostgreSQL)')
+	parser.add_argument('--distributions', dest='distributions', type=int, default=50, help='number of queued distributions (default: 50)')
+	parser.add_argument('--unmet', dest='unmet', type=float, default=0.1, help='share of distributions with unmet prerequisities (default: 0.1)')
+	parser.add_argument('--jobs', dest='jobs', type=int, default=2, help='number of workers (default: 2)')
+	parser.add_argument('--install-ms', dest='install_ms', type=int, default=200, help='duration of the install phase (default: 200)')
+	parser.add_argument('--load-ms', dest='load_ms', type=int, default=50, help='duration of the load phase (default: 50)')
+	parser.add_argument('--check-ms', dest='check_ms', type=int, default=300, help='duration of the check phase (default: 300)')
+	parser.add_argument('--log-bytes', dest='log_bytes', type=int, default=65536, help='size of the output of each phase (default: 64kB)')
+	parser.add_argument('--diff-bytes', dest='diff_bytes', type=int, default=65536, help='size of regression.diffs of a failed check (default: 64kB)')
+	parser.add_argument('--fail', dest='fail', type=float, default=0.2, help='share of distributions failing the check (default: 0.2)')
+	parser.add_argument('--hang', dest='hang', type=float, default=0.0, help='share of distributions hanging in the check (default: 0)')
+	parser.add_argument('--deps', dest='deps', type=float, default=0.0, help='share of distributions requiring a shared dependency (default: 0)')
+	parser.add_argument('--extra', dest='extra', default='', help='additional options for run-tests.py (e.g. "--warm-cluster")')
+	parser.add_argument('--keep', dest='keep', action='store_true', default=False, help='keep the working directory (logs etc.)')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='bench-')
+
+	try:
+		report(args, *run(args, workdir))
+	finally:
+		if args.keep:
+			print 'working directory: %(dir)s' % {'dir' : workdir}
+		else:
+			shutil.rmtree(workdir, ignore_errors=True)
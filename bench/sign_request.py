@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''micro-benchmark of the request signing - compares the original sign_request (str() of each value) with the current
+implementation, on payloads with large (base64-encoded) logs passed either as strings or as files'''
+
+import argparse
+import base64
+import hashlib
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libs'))
+
+from utils import compute_signature
+
+def sign_request_baseline(data, secret):
+	'the original implementation (before the streaming signing)'
+
+	keys = data.keys()
+	digest = hashlib.sha256()
+	digest.update(secret)
+
+	keys = sorted(data.keys())
+
+	for k in keys:
+		digest.update(k)
+		digest.update(':')
+		digest.update(str(data[k]))
+		digest.update(';')
+
+	return digest.hexdigest()
+
+# 1MB of base64 data (deterministic, so that all the variants sign the same payload)
+BLOCK = base64.b64encode(''.join([hashlib.sha256(str(i)).digest() for i in range(786432 / 32)]))
+
+LOGS = ['install_log', 'load_log', 'check_log']
+
+def payload(size):
+	'''result with three logs of the requested size in MB (strings), and a small pg_config blob'''
+
+	data = dict([(k, BLOCK * size) for k in LOGS])
+
+	data.update({'distribution' : 'bench', 'version' : '1.0.0', 'install' : 'ok', 'load' : 'ok', 'check' : 'ok',
+				 'install_duration' : 1000, 'load_duration' : 100, 'check_duration' : 10000, 'config' : '{"VERSION" : "PostgreSQL 9.3.4"}'})
+
+	return data
+
+def payload_files(size):
+	'''the same payload, but with logs written into temporary files (e.g. spooled results), never held in memory'''
+
+	data = payload(0)
+
+	for k in LOGS:
+		f = tempfile.TemporaryFile()
+		for i in range(size):
+			f.write(BLOCK)
+		f.seek(0)
+		data[k] = f
+
+	return data
+
+def measure(setup, func, runs):
+	'''runs the setup and function in a forked child (so that the peak memory includes only this variant), returns the
+	best time in ms, peak RSS in MB and the result'''
+
+	(rfd, wfd) = os.pipe()
+	pid = os.fork()
+
+	if pid == 0:
+		os.close(rfd)
+
+		data = setup()
+
+		best = None
+		for i in range(runs):
+			start = time.time()
+			result = func(data)
+			duration = time.time() - start
+			if (best is None) or (duration < best):
+				best = duration
+
+		os.write(wfd, '%f %d %s' % (best * 1000, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, result))
+		os._exit(0)
+
+	os.close(wfd)
+	output = os.read(rfd, 4096)
+	os.waitpid(pid, 0)
+
+	(duration, rss, result) = output.split(' ')
+
+	return (float(duration), int(rss) / 1024.0, result)
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='sign_request micro-benchmark')
+	parser.add_argument('--sizes', dest='sizes', default='1,16,64', help='log sizes in MB (default: 1,16,64)')
+	parser.add_argument('--runs', dest='runs', type=int, default=5, help='number of runs (default: 5)')
+	args = parser.parse_args()
+
+	secret = 'secretkey'
+
+	print '%10s %-22s %12s %12s' % ('log (MB)', 'variant', 'time (ms)', 'RSS (MB)')
+
+	for size in [int(s) for s in args.sizes.split(',')]:
+
+		variants = [('baseline (strings)', lambda: payload(size), lambda data: sign_request_baseline(data, secret)),
+					('streaming (strings)', lambda: payload(size), lambda data: compute_signature(data, secret)),
+					('streaming (files)', lambda: payload_files(size), lambda data: compute_signature(data, secret))]
+
+		signatures = set()
+
+		for (name, setup, func) in variants:
+			(duration, rss, signature) = measure(setup, func, args.runs)
+			signatures.add(signature)
+			print '%10d %-22s %12.1f %12.1f' % (size, name, duration, rss)
+
+		if len(signatures) != 1:
+			print 'ERROR: signatures do not match'
+			sys.exit(1)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+'''stub pgxnclient and PostgreSQL tools (pg_config, initdb, pg_ctl, createdb, ...) for benchmarking the client - the
+stubs only sleep and produce output, configured by environment variables:
+
+    BENCH_ROOT         directory of the fake installation (SHAREDIR, ...)
+    BENCH_INSTALL_MS   duration of "pgxnclient install" (and similarly BENCH_LOAD_MS, BENCH_CHECK_MS)
+    BENCH_LOG_BYTES    size of the output of each pgxnclient phase
+    BENCH_DIFF_BYTES   size of regression.diffs of a failed check
+    BENCH_FAIL         share of the distributions failing the check (0-1)
+    BENCH_HANG         share of the distributions hanging in the check (0-1)
+    BENCH_DEPS         share of the distributions requiring the (shared) "benchdep" extension from PGXN (0-1)
+
+each stub is invoked as "stubs.py NAME ARGS..." (see write_stubs)'''
+
+import hashlib
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+import zipfile
+
+STUBS = ['pgxnclient', 'pg_config', 'initdb', 'pg_ctl', 'createdb', 'dropdb', 'createuser', 'psql']
+
+def write_stubs(bindir):
+	'creates the stub executables in bindir (shell wrappers running this script with the current interpreter)'
+
+	if not os.path.isdir(bindir):
+		os.makedirs(bindir)
+
+	for name in STUBS:
+		fname = os.path.join(bindir, name)
+		with open(fname, 'w') as f:
+			f.write('#!/bin/sh\nexec "%(python)s" "%(script)s" %(name)s "$@"\n' % {'python' : sys.executable, 'script' : os.path.abspath(__file__), 'name' : name})
+		os.chmod(fname, 0755)
+
+def _env(name, default):
+	return type(default)(os.environ.get(name, default))
+
+def _selected(spec, share):
+	'deterministic choice of a share of the distributions (by hash of the name)'
+
+	return (int(hashlib.sha1(spec).hexdigest()[:8], 16) % 1000) < share * 1000
+
+def _output(phase, spec):
+	'writes the configured amount of (make-like) output'
+
+	line = '%(phase)s %(spec)s: gcc -O2 -Wall -fpic -I. -I/usr/include/postgresql/server -c -o obj.o src.c\n' % {'phase' : phase, 'spec' : spec}
+	count = _env('BENCH_LOG_BYTES', 65536) / len(line) + 1
+
+	sys.stdout.write(line * count)
+	sys.stdout.flush()
+
+def pgxnclient(args):
+
+	if args[0] == '--version':
+		print 'pgxnclient 1.2.1 (bench stub)'
+		return 0
+
+	command = args[0]
+	spec = args[-1]
+
+	if command == 'download':
+		target = args[args.index('--target') + 1]
+		(name, version) = spec.split('=', 1)
+		prereqs = {'runtime' : {'requires' : {'PostgreSQL' : '8.2.0'}}}
+
+		if _selected(name + ':deps', _env('BENCH_DEPS', 0.0)):
+			prereqs['runtime']['requires']['benchdep'] = '1.0.0'
+
+		with zipfile.ZipFile(os.path.join(target, '%(name)s-%(version)s.zip' % {'name' : name, 'version' : version}), 'w') as z:
+			z.writestr('%(name)s-%(version)s/META.json' % {'name' : name, 'version' : version}, json.dumps({'name' : name, 'version' : version, 'prereqs' : prereqs}))
+			z.writestr('%(name)s-%(version)s/src.c' % {'name' : name, 'version' : version}, hashlib.sha256(spec).digest() * 1024)
+		print 'saving %(spec)s' % {'spec' : spec}
+		return 0
+
+	# archive, or a dependency (name with a version constraint)
+	spec = re.split('[<>=!]', os.path.basename(spec))[0]
+
+	time.sleep(_env('BENCH_%(phase)s_MS' % {'phase' : command.upper()}, 0) / 1000.0)
+
+	_output(command, spec)
+
+	if command == 'install':
+
+		# something to cache / install (DESTDIR is honored, like by PGXS)
+		extdir = os.environ.get('DESTDIR', '') + os.path.join(os.environ['BENCH_ROOT'], 'share', 'extension')
+		if not os.path.isdir(extdir):
+			os.makedirs(extdir)
+		with open(os.path.join(extdir, '%(spec)s.control' % {'spec' : spec}), 'w') as f:
+			f.write("default_version = '1.0'\n")
+
+	if command == 'check':
+
+		if _selected(spec + ':hang', _env('BENCH_HANG', 0.0)):
+			time.sleep(86400)
+
+		if _selected(spec, _env('BENCH_FAIL', 0.0)):
+
+			# pgxnclient copies regression.diffs into the working directory
+			line = '! expected output differs\n'
+			with open('regression.diffs', 'w') as f:
+				f.write('*** /tmp/build/expected/%(spec)s.out\n--- /tmp/build/results/%(spec)s.out\n***************\n' % {'spec' : spec})
+				f.write(line * (_env('BENCH_DIFF_BYTES', 4096) / len(line) + 1))
+
+			print 'The differences that caused some tests to fail can be viewed in the file "%(dir)s/regression.diffs".' % {'dir' : os.getcwd()}
+			return 2
+
+	return 0
+
+def pg_config(args):
+
+	root = os.environ['BENCH_ROOT']
+
+	print 'BINDIR = %(dir)s' % {'dir' : os.path.join(root, 'bin')}
+	print 'SHAREDIR = %(dir)s' % {'dir' : os.path.join(root, 'share')}
+	print 'CC = cc'
+	print "CONFIGURE = '--prefix=%(dir)s'" % {'dir' : root}
+	print 'VERSION = PostgreSQL 9.3.4'
+
+	return 0
+
+def _option(args, name):
+	return args[args.index(name) + 1]
+
+def initdb(args):
+
+	datadir = _option(args, '-D')
+	os.makedirs(datadir)
+
+	for (fname, contents) in [('PG_VERSION', '9.3\n'), ('postgresql.conf', "# stub\n")]:
+		with open(os.path.join(datadir, fname), 'w') as f:
+			f.write(contents)
+
+	return 0
+
+def _postmaster(datadir):
+	'pid of the running fake postmaster, or None'
+
+	try:
+		with open(os.path.join(datadir, 'postmaster.pid'), 'r') as f:
+			pid = int(f.readline().strip())
+		os.kill(pid, 0)
+		return pid
+	except (IOError, OSError, ValueError):
+		return None
+
+def pg_ctl(args):
+
+	datadir = _option(args, '-D')
+	command = args[-1]
+
+	if command == 'start':
+
+		# the "postmaster" is just a sleeping process (in its own session, so that it outlives pg_ctl)
+		with open(os.devnull, 'w') as devnull:
+			process = subprocess.Popen(['sleep', '1000000'], stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
+
+		with open(os.path.join(datadir, 'postmaster.pid'), 'w') as f:
+			f.write('%(pid)d\n%(dir)s\n' % {'pid' : process.pid, 'dir' : datadir})
+
+		if '-l' in args:
+			with open(_option(args, '-l'), 'a') as f:
+				f.write('LOG:  database system is ready to accept connections\n')
+
+		return 0
+
+	pid = _postmaster(datadir)
+
+	if command == 'status':
+		return (0 if pid is not None else 3)
+
+	if command == 'stop':
+		if pid is not None:
+			os.kill(pid, signal.SIGTERM)
+		if os.path.exists(os.path.join(datadir, 'postmaster.pid')):
+			os.remove(os.path.join(datadir, 'postmaster.pid'))
+		return 0
+
+	return 1
+
+def psql(args):
+
+	# the only query the client runs is the snapshot of template1 (number of objects)
+	print '1,1,1,1,1'
+
+	return 0
+
+def noop(args):
+	return 0
+
+if __name__ == '__main__':
+
+	handlers = {'pgxnclient' : pgxnclient, 'pg_config' : pg_config, 'initdb' : initdb, 'pg_ctl' : pg_ctl, 'psql' : psql,
+				'createdb' : noop, 'dropdb' : noop, 'createuser' : noop}
+
+	sys.exit(handlers[sys.argv[1]](sys.argv[2:]))
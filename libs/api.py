@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+import httplib
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import gzip
+import StringIO
+
+from telemetry import metrics, span
+
+class ApiException(Exception):
+	pass
+
+def gzip_compress(data):
+	'gzip-compress the string (request body)'
+
+	buf = StringIO.StringIO()
+
+	with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+		f.write(data)
+
+	return buf.getvalue()
+
+def gzip_decompress(data):
+	'decompress gzip-encoded string (response body)'
+
+	with gzip.GzipFile(fileobj=StringIO.StringIO(data), mode='rb') as f:
+		return f.read()
+
+class ApiClient(object):
+	'''client for the tester API - keeps a pool of keep-alive connections shared by all threads, retries failed requests
+	with exponential backoff (with jitter, up to a total deadline) and tracks number/duration of the requests'''
+
+	def __init__(self, host, timeout=60, retries=5, backoff=1.0, max_backoff=30.0, deadline=120.0, compress=True):
+		self._host = host
+		self._timeout = timeout
+		self._retries = retries
+		self._backoff = backoff
+		self._max_backoff = max_backoff
+		self._deadline = deadline
+		self._compress = compress
+
+		self._lock = threading.Lock()
+		self._idle = []
+		self._stats = {}
+
+	def _connect(self):
+		'new connection to the API host'
+
+		return httplib.HTTPConnection(self._host, timeout=self._timeout)
+
+	def _acquire(self):
+		'returns an idle connection from the pool (or a new one), and whether it was reused from the pool'
+
+		with self._lock:
+			if self._idle:
+				return (self._idle.pop(), True)
+
+		return (self._connect(), False)
+
+	def _release(self, conn):
+		'returns the connection to the pool, so that it can be reused by the next request'
+
+		with self._lock:
+			self._idle.append(conn)
+
+	def _record(self, method, duration, error=False):
+		'updates request statistics (count, errors, total duration)'
+
+		with self._lock:
+			stats = self._stats.setdefault(method, {'requests' : 0, 'errors' : 0, 'duration' : 0.0})
+			stats['requests'] += 1
+			stats['duration'] += duration
+			if error:
+				stats['errors'] += 1
+
+		metrics.inc('pgxn_tester_api_requests_total', {'method' : method})
+
+		if error:
+			metrics.inc('pgxn_tester_api_errors_total', {'method' : method})
+
+	def stats(self):
+		'returns copy of the request statistics (per HTTP method)'
+
+		with self._lock:
+			return dict([(k, dict(v)) for (k, v) in self._stats.items()])
+
+	def log_stats(self):
+		'writes the request statistics into the log'
+
+		for (method, stats) in sorted(self.stats().items()):
+			logging.info("API %(method)s requests: %(requests)d (errors %(errors)d), total %(duration).1f s" % dict(stats, method=method))
+
+	def close(self):
+		'closes all the idle connections'
+
+		with self._lock:
+			(idle, self._idle) = (self._idle, [])
+
+		for conn in idle:
+			conn.close()
+
+	def _delay(self, attempt):
+		'exponential backoff with "full jitter"'
+
+		return random.uniform(0, min(self._max_backoff, self._backoff * (2 ** attempt)))
+
+	def _request(self, method, uri, body=None, headers=None):
+		'single request on a pooled connection, returns (status, body, headers)'
+
+		(conn, reused) = self._acquire()
+		start_time = time.time()
+
+		try:
+			with span('api', method=method, uri=uri) as attrs:
+
+				while True:
+					try:
+						conn.request(method, uri, body, headers or {})
+						response = conn.getresponse()
+						break
+					except socket.timeout:
+						raise
+					except (httplib.HTTPException, socket.error):
+						# the server may have closed the idle keep-alive connection (no response at all), so retry on
+						# a new connection right away - that's not an API error
+						if not reused:
+							raise
+						conn.close()
+						(conn, reused) = (self._connect(), False)
+
+				data = response.read()
+
+				attrs['status'] = response.status
+
+			if response.getheader('Content-Encoding', '') == 'gzip':
+				data = gzip_decompress(data)
+
+			# the server may not support keep-alive, in that case don't put the connection back
+			if response.will_close:
+				conn.close()
+			else:
+				self._release(conn)
+
+			self._record(method, time.time() - start_time, error=(response.status >= 500))
+
+			return (response.status, data, dict(response.getheaders()))
+
+		except:
+			conn.close()
+			self._record(method, time.time() - start_time, error=True)
+			raise
+
+	def request(self, method, uri, body=None, headers=None):
+		'''request with retries (on connection failures and 5xx responses), returns (status, body) - gives up after the
+		number of retries or when the deadline is exceeded, raising ApiException'''
+
+		(status, data, response_headers) = self._retry(method, uri, body, headers)
+
+		return (status, data)
+
+	def _retry(self, method, uri, body=None, headers=None):
+		'the request with retries, returns (status, body, headers)'
+
+		headers = dict(headers or {})
+		headers['Accept-Encoding'] = 'gzip'
+
+		# URIs built from the templates (JSON) are unicode, and httplib would then fail to concatenate the request with
+		# a binary (gzip-compressed) body
+		if isinstance(uri, unicode):
+			uri = uri.encode('utf-8')
+
+		deadline = time.time() + self._deadline
+		attempt = 0
+
+		while True:
+
+			try:
+				(status, data, response_headers) = self._request(method, uri, body, headers)
+
+				if status < 500:
+					return (status, data, response_headers)
+
+				msg = 'HTTP status %(status)d' % {'status' : status}
+
+			except Exception as ex:
+				msg = str(ex)
+
+			delay = self._delay(attempt)
+			attempt += 1
+
+			if (attempt > self._retries) or (time.time() + delay > deadline):
+				raise ApiException("%(method)s '%(host)s' '%(uri)s' failed: %(msg)s" % {'method' : method, 'host' : self._host, 'uri' : uri, 'msg' : msg})
+
+			logging.warning("attempt to %(method)s '%(host)s' '%(uri)s' failed: %(msg)s (retry in %(delay).1f s)" % {'method' : method, 'host' : self._host, 'uri' : uri, 'msg' : msg, 'delay' : delay})
+			time.sleep(delay)
+
+	def get(self, uri):
+		'GET request, returns JSON object'
+
+		(status, data) = self.request('GET', uri)
+
+		return json.loads(data)
+
+	def get_modified(self, uri, validators=None):
+		'''conditional GET request (If-None-Match / If-Modified-Since, using validators of the previous response), returns
+		(JSON object, validators) - the object is None when not modified since the previous request'''
+
+		validators = validators or {}
+		headers = {}
+
+		if validators.get('etag'):
+			headers['If-None-Match'] = validators['etag']
+
+		if validators.get('last-modified'):
+			headers['If-Modified-Since'] = validators['last-modified']
+
+		(status, data, response_headers) = self._retry('GET', uri, headers=headers)
+
+		if status == 304:
+			return (None, validators)
+
+		if status != 200:
+			raise ApiException("GET '%(host)s' '%(uri)s' failed: HTTP status %(status)d" % {'host' : self._host, 'uri' : uri, 'status' : status})
+
+		validators = dict([(k, v) for (k, v) in response_headers.items() if k in ('etag', 'last-modified')])
+
+		return (json.loads(data), validators)
+
+	def post(self, uri, data):
+		'''POST request with JSON body (gzip-compressed, unless disabled), returns (status, response) - the response is
+		parsed as JSON only for 200, other replies (e.g. an HTML error page of a proxy) return the body as it is'''
+
+		body = json.dumps(data)
+		headers = {'Content-type' : 'application/json'}
+
+		if self._compress:
+			body = gzip_compress(body)
+			headers['Content-Encoding'] = 'gzip'
+
+		(status, response) = self.request('POST', uri, body, headers)
+
+		if status != 200:
+			return (status, response)
+
+		return (status, json.loads(response))
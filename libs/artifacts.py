@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from telemetry import metrics
+
+class ArtifactCacheException(Exception):
+	pass
+
+def fingerprint(pginfo, compiler):
+	'fingerprint of the build environment of a PostgreSQL installation (pg_config output and compiler version)'
+
+	digest = hashlib.sha256()
+	digest.update(json.dumps(pginfo, sort_keys=True))
+	digest.update(json.dumps(compiler))
+
+	return digest.hexdigest()
+
+class ArtifactCache(object):
+	'''cache of built distributions - the files installed by 'make install' (into a DESTDIR stage directory), keyed by
+	distribution, version and fingerprint of the installation (pg_config output and compiler version, see fingerprint),
+	with LRU eviction when the total size exceeds the limit (the source archives are kept in the DownloadCache) - a
+	single instance is shared by all the installations, so that eviction never races with a lookup'''
+
+	def __init__(self, directory, max_size):
+		self._dir = os.path.abspath(directory)
+		self._max_size = max_size
+		self._lock = threading.Lock()
+
+		if not os.path.isdir(self._dir):
+			os.makedirs(self._dir)
+
+	def key(self, fingerprint, distribution, version):
+		return hashlib.sha256('%(fp)s:%(dist)s:%(version)s' % {'fp' : fingerprint, 'dist' : distribution, 'version' : version}).hexdigest()[:32]
+
+	def _path(self, key):
+		return os.path.join(self._dir, key)
+
+	def lookup(self, key):
+		'is the build cached? (also marks the entry as recently used)'
+
+		meta = os.path.join(self._path(key), 'meta.json')
+
+		with self._lock:
+
+			if not os.path.exists(meta):
+				metrics.inc('pgxn_tester_cache_requests_total', {'cache' : 'builds', 'result' : 'miss'})
+				return False
+
+			os.utime(meta, None)
+
+		metrics.inc('pgxn_tester_cache_requests_total', {'cache' : 'builds', 'result' : 'hit'})
+
+		return True
+
+	def store(self, key, distribution, version, stagedir, install_log):
+		'''adds the build into the cache - the DESTDIR stage directory and the install log (the entry is prepared in
+		a temporary directory and renamed, so that it's never seen incomplete)'''
+
+		path = self._path(key)
+		tmppath = '%(path)s.tmp-%(pid)d' % {'path' : path, 'pid' : os.getpid()}
+
+		try:
+			os.makedirs(tmppath)
+
+			shutil.copytree(stagedir, os.path.join(tmppath, 'install'), symlinks=True)
+			shutil.copy2(install_log, os.path.join(tmppath, 'install.log'))
+
+			with open(os.path.join(tmppath, 'meta.json'), 'w') as f:
+				json.dump({'distribution' : distribution, 'version' : version, 'created' : time.time()}, f)
+
+			with self._lock:
+				if os.path.exists(path):
+					shutil.rmtree(path)
+				os.rename(tmppath, path)
+
+		except Exception as ex:
+			logging.warning("failed to cache build of '%(dist)s-%(version)s': %(msg)s" % {'dist' : distribution, 'version' : version, 'msg' : str(ex)})
+			shutil.rmtree(tmppath, ignore_errors=True)
+			return
+
+		self._evict()
+
+	def install(self, key, log_fname):
+		'''copies the cached files into the PostgreSQL installation (i.e. does what "make install" would do), and the log
+		of the build into log_fname - raises ArtifactCacheException when the entry is not in the cache (anymore)'''
+
+		path = self._path(key)
+
+		# the entry must not get evicted half-way through
+		with self._lock:
+
+			if not os.path.exists(os.path.join(path, 'meta.json')):
+				raise ArtifactCacheException("build '%(key)s' is not cached" % {'key' : key})
+
+			shutil.copy2(os.path.join(path, 'install.log'), log_fname)
+			install_copy(os.path.join(path, 'install'))
+
+	def _size(self, path):
+
+		size = 0
+
+		for (root, dirs, files) in os.walk(path):
+			for f in files:
+				fname = os.path.join(root, f)
+				if not os.path.islink(fname):
+					size += os.path.getsize(fname)
+
+		return size
+
+	def _evict(self):
+		'removes the least recently used entries, until the cache fits into the size limit (keeps the newest entry)'
+
+		with self._lock:
+
+			entries = []
+
+			for key in os.listdir(self._dir):
+
+				# entries being stored (already with meta.json, but not renamed yet)
+				if '.tmp-' in key:
+					continue
+
+				meta = os.path.join(self._dir, key, 'meta.json')
+				if os.path.exists(meta):
+					entries.append((os.path.getmtime(meta), key, self._size(os.path.join(self._dir, key))))
+
+			entries.sort()
+
+			total = sum([e[2] for e in entries])
+
+			for (mtime, key, size) in entries[:-1]:
+
+				if total <= self._max_size:
+					break
+
+				logging.info("evicting build '%(key)s' from the cache (%(size)d bytes)" % {'key' : key, 'size' : size})
+
+				shutil.rmtree(os.path.join(self._dir, key), ignore_errors=True)
+				total -= size
+
+
+def install_copy(stagedir):
+	'copies files from the DESTDIR stage directory to their actual location (stagedir/usr/lib/x => /usr/lib/x)'
+
+	for (root, dirs, files) in os.walk(stagedir):
+
+		target = os.path.join('/', os.path.relpath(root, stagedir))
+
+		if not os.path.isdir(target):
+			os.makedirs(target)
+
+		for f in files:
+			src = os.path.join(root, f)
+			dst = os.path.join(target, f)
+
+			if os.path.lexists(dst):
+				os.remove(dst)
+
+			if os.path.islink(src):
+				os.symlink(os.readlink(src), dst)
+			else:
+				shutil.copy2(src, dst)
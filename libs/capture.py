@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+import base64
+import codecs
+import hashlib
+import os
+import re
+
+# chunk size for reading the logs (multiple of 3, so that base64-encoded chunks can be simply concatenated)
+CHUNK_SIZE = 3 * 65536
+
+class CapturedLog(object):
+	'''output of a command, captured in a log file - the log is never read into memory as a whole, and only the first and
+	last (limit/2) bytes get uploaded (with a marker, including size and SHA-256 of the full log)'''
+
+	def __init__(self, fname, limit=4194304):
+		self._fname = fname
+		self._limit = limit
+
+	def size(self):
+		return os.path.getsize(self._fname)
+
+	def _lines(self):
+		'lines of the log (very long lines are returned in pieces)'
+
+		with open(self._fname, 'rb') as f:
+			for line in iter(lambda: f.readline(CHUNK_SIZE), ''):
+				yield line
+
+	def find(self, needle):
+		'offset of the first occurrence of the string (like str.find, -1 when not found)'
+
+		offset = 0
+
+		for line in self._lines():
+			idx = line.find(needle)
+			if idx >= 0:
+				return offset + idx
+			offset += len(line)
+
+		return -1
+
+	def search(self, pattern):
+		'first match of the regular expression (searching line by line), or None'
+
+		for line in self._lines():
+			res = re.search(pattern, line)
+			if res:
+				return res
+
+		return None
+
+	def sha256(self):
+		'SHA-256 of the full log (computed incrementally)'
+
+		digest = hashlib.sha256()
+
+		with open(self._fname, 'rb') as f:
+			for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+				digest.update(chunk)
+
+		return digest.hexdigest()
+
+	def _read(self, f, length):
+		'reads up to length bytes from the file, in chunks'
+
+		while length > 0:
+			chunk = f.read(min(length, CHUNK_SIZE))
+			if not chunk:
+				return
+			length -= len(chunk)
+			yield chunk
+
+	def _chunks(self):
+		'contents of the log, truncated to the head/tail when exceeding the limit'
+
+		size = self.size()
+
+		with open(self._fname, 'rb') as f:
+
+			if size <= self._limit:
+				for chunk in self._read(f, size):
+					yield chunk
+				return
+
+			half = self._limit / 2
+
+			for chunk in self._read(f, half):
+				yield chunk
+
+			yield "\n\n[... %(skipped)d bytes truncated, full log has %(size)d bytes, SHA-256 %(sha)s ...]\n\n" % {'skipped' : (size - 2 * half), 'size' : size, 'sha' : self.sha256()}
+
+			f.seek(size - half)
+
+			for chunk in self._read(f, half):
+				yield chunk
+
+	def encode(self):
+		'''base64-encoded (and possibly truncated) log, built incrementally - invalid UTF-8 sequences are replaced, so that
+		the server can decode the log'''
+
+		decoder = codecs.getincrementaldecoder('utf-8')('replace')
+		encoded = []
+		pending = ''
+
+		for chunk in self._chunks():
+
+			pending += decoder.decode(chunk).encode('utf-8')
+
+			n = len(pending) - (len(pending) % 3)
+			encoded.append(base64.b64encode(pending[:n]))
+			pending = pending[n:]
+
+		pending += decoder.decode('', final=True).encode('utf-8')
+		encoded.append(base64.b64encode(pending))
+
+		return ''.join(encoded)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import logging
+import psutil
+import subprocess
+import threading
+
+def _communicate(command, budget, env=None):
+	'''runs the command, returns its output (killing it when it does not finish within the budget, in seconds)'''
+
+	process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+
+	timer = threading.Timer(budget, process.kill)
+	timer.start()
+
+	try:
+		(out, err) = process.communicate()
+	finally:
+		timer.cancel()
+
+	if process.returncode < 0:
+		out += "\n[killed after %(budget)d s]\n" % {'budget' : budget}
+
+	return out.decode('utf-8', 'replace')
+
+def process_snapshot(p):
+	'CPU / memory / file descriptors of the process'
+
+	try:
+		cpu = p.cpu_times()
+		mem = p.memory_info()
+		return {'pid' : p.pid, 'name' : p.name(), 'cmdline' : ' '.join(p.cmdline()), 'status' : p.status(),
+				'cpu_user' : cpu.user, 'cpu_system' : cpu.system, 'rss' : mem.rss, 'vms' : mem.vms, 'fds' : p.num_fds()}
+	except psutil.Error as ex:
+		return {'pid' : p.pid, 'error' : str(ex)}
+
+def backtrace(pid, budget):
+	'backtrace of the process (using gdb in batch mode)'
+
+	try:
+		return _communicate(['gdb', '-p', str(pid), '-ex', 'bt', '--batch'], budget)
+	except Exception as ex:
+		return 'gdb failed: %(msg)s' % {'msg' : str(ex)}
+
+def pg_stat_activity(env, budget):
+	'contents of pg_stat_activity (as text, the columns differ between PostgreSQL versions)'
+
+	try:
+		return _communicate(['psql', '-X', '-d', 'postgres', '-c', 'SELECT * FROM pg_stat_activity'], budget, env=env)
+	except Exception as ex:
+		return 'psql failed: %(msg)s' % {'msg' : str(ex)}
+
+def collect_diagnostics(process, postmaster=None, env=None, budget=10, parallel=8):
+	'''diagnostics of a hung test - snapshots of the command's process tree and the cluster processes, backtraces of the
+	cluster processes (collected concurrently, each within the time budget) and pg_stat_activity'''
+
+	commands = []
+	cluster = []
+
+	try:
+		command = psutil.Process(process.pid)
+		commands = [command] + command.children(recursive=True)
+	except psutil.Error:
+		pass
+
+	if postmaster is not None:
+		try:
+			cluster = [postmaster] + postmaster.children(recursive=True)
+		except psutil.Error:
+			pass
+
+	diagnostics = {'commands' : [process_snapshot(p) for p in commands], 'cluster' : [process_snapshot(p) for p in cluster]}
+
+	# backtraces of the cluster processes, at most 'parallel' gdb processes at a time
+	backtraces = {}
+	semaphore = threading.Semaphore(parallel)
+
+	def collect(pid):
+		with semaphore:
+			backtraces[pid] = backtrace(pid, budget)
+
+	threads = [threading.Thread(target=collect, args=(p.pid,)) for p in cluster]
+
+	for t in threads:
+		t.start()
+
+	if postmaster is not None:
+		diagnostics['pg_stat_activity'] = pg_stat_activity(env, budget)
+
+	for t in threads:
+		t.join()
+
+	for snapshot in diagnostics['cluster']:
+		snapshot['backtrace'] = backtraces.get(snapshot['pid'])
+
+	logging.info("collected diagnostics of %(commands)d command and %(cluster)d cluster processes" % {'commands' : len(commands), 'cluster' : len(cluster)})
+
+	return diagnostics
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from telemetry import metrics
+from utils import write_atomic
+
+class DownloadCache(object):
+	'''content-addressed cache of distribution archives, shared by all PostgreSQL versions and runs - the archives are
+	stored as objects/$sha1/$archive, with an index mapping distribution/version to the SHA-1 (pgxnclient verifies the
+	checksum from PGXN when downloading, the cache verifies it again whenever the archive is reused)'''
+
+	def __init__(self, directory):
+		self._dir = os.path.abspath(directory)
+		self._lock = threading.Lock()
+		self._locks = {}
+
+		for d in ['index', 'objects']:
+			if not os.path.isdir(os.path.join(self._dir, d)):
+				os.makedirs(os.path.join(self._dir, d))
+
+	def _key_lock(self, distribution, version):
+		'lock for the distribution version (so that concurrent threads download it only once)'
+
+		with self._lock:
+			return self._locks.setdefault((distribution, version), threading.Lock())
+
+	def _index(self, distribution, version):
+		return os.path.join(self._dir, 'index', '%(dist)s-%(version)s' % {'dist' : distribution, 'version' : version})
+
+	def _sha1(self, fname):
+
+		digest = hashlib.sha1()
+
+		with open(fname, 'rb') as f:
+			for chunk in iter(lambda: f.read(65536), ''):
+				digest.update(chunk)
+
+		return digest.hexdigest()
+
+	def lookup(self, distribution, version):
+		'path to the cached archive (with verified checksum), or None'
+
+		index = self._index(distribution, version)
+
+		if not os.path.exists(index):
+			return None
+
+		with open(index, 'r') as f:
+			(sha1, name) = f.read().strip().split(' ', 1)
+
+		archive = os.path.join(self._dir, 'objects', sha1, name)
+
+		if not os.path.exists(archive):
+			return None
+
+		if self._sha1(archive) != sha1:
+			logging.warning("cached archive '%(archive)s' is corrupted, removing it" % {'archive' : archive})
+			shutil.rmtree(os.path.dirname(archive), ignore_errors=True)
+			return None
+
+		return archive
+
+	def fetch(self, distribution, version, state_opt, log_fname, env=None):
+		'''returns path to the archive, downloading it only if not cached yet (the output goes into the log), or None if
+		the download failed'''
+
+		with self._key_lock(distribution, version):
+
+			archive = self.lookup(distribution, version)
+
+			if archive is not None:
+				metrics.inc('pgxn_tester_cache_requests_total', {'cache' : 'downloads', 'result' : 'hit'})
+				with open(log_fname, 'w') as logfile:
+					logfile.write("using cached archive '%(archive)s'\n" % {'archive' : archive})
+				return archive
+
+			metrics.inc('pgxn_tester_cache_requests_total', {'cache' : 'downloads', 'result' : 'miss'})
+
+			tmpdir = tempfile.mkdtemp(prefix='download-', dir=self._dir)
+
+			try:
+
+				with open(log_fname, 'w') as logfile:
+					r = subprocess.call(['pgxnclient', 'download', state_opt, '--target', tmpdir, '%(dist)s=%(version)s' % {'dist' : distribution, 'version' : version}], stdout=logfile, stderr=logfile, env=env)
+
+				if (r != 0) or (len(os.listdir(tmpdir)) != 1):
+					return None
+
+				name = os.listdir(tmpdir)[0]
+				sha1 = self._sha1(os.path.join(tmpdir, name))
+
+				objdir = os.path.join(self._dir, 'objects', sha1)
+
+				# the same archive may be published under a different name/version, or downloaded by another process
+				if not os.path.exists(objdir):
+					os.rename(tmpdir, objdir)
+				elif not os.path.exists(os.path.join(objdir, name)):
+					os.rename(os.path.join(tmpdir, name), os.path.join(objdir, name))
+
+				# write the index entry (write and rename)
+				write_atomic(self._index(distribution, version), '%(sha1)s %(name)s\n' % {'sha1' : sha1, 'name' : name})
+
+				logging.info("cached archive '%(name)s' (sha1 %(sha1)s)" % {'name' : name, 'sha1' : sha1})
+
+				return os.path.join(objdir, name)
+
+			finally:
+				shutil.rmtree(tmpdir, ignore_errors=True)
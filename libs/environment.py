@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+import platform
+import subprocess
+import threading
+
+from pgcluster import pg_config
+from utils import write_atomic
+
+def which(program, env=None):
+	'full path to the program (searching PATH in the environment), or None'
+
+	path = (env or os.environ).get('PATH', os.defpath)
+
+	for d in path.split(os.pathsep):
+		fname = os.path.join(d, program)
+		if os.path.isfile(fname) and os.access(fname, os.X_OK):
+			return os.path.abspath(fname)
+
+	return None
+
+def _stamp(fname):
+	'identifies version of the file (path, size and mtime) - None if there is no such file'
+
+	if (fname is None) or (not os.path.exists(fname)):
+		return None
+
+	st = os.stat(fname)
+
+	return '%(path)s:%(size)d:%(mtime)d' % {'path' : os.path.realpath(fname), 'size' : st.st_size, 'mtime' : int(st.st_mtime)}
+
+def _first_line(command, env=None):
+	'first line of the output (stdout or stderr) of the command, or "unknown" when it fails'
+
+	try:
+		process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+		(out, err) = process.communicate()
+		return (out.strip().split("\n")[0] or 'unknown')
+	except Exception as ex:
+		logging.warning("failed to run '%(cmd)s': %(msg)s" % {'cmd' : ' '.join(command), 'msg' : str(ex)})
+		return 'unknown'
+
+def _uname():
+	'system, kernel release / version and machine (not the hostname), not cached as it is cheap and changes on reboot'
+
+	(sysname, nodename, release, version, machine) = os.uname()
+
+	return ' '.join([sysname, release, version, machine])
+
+class EnvironmentCache(object):
+	'''cache of the environment probes of PostgreSQL installations (pg_config output, compiler and pgxnclient version),
+	stored in a JSON file - an entry is reused as long as the binaries it describes did not change (size/mtime)'''
+
+	def __init__(self, fname):
+		self._fname = fname
+		self._lock = threading.Lock()
+		self._entries = {}
+
+		if os.path.exists(fname):
+			try:
+				with open(fname, 'r') as f:
+					self._entries = json.load(f)
+			except Exception as ex:
+				logging.warning("failed to read environment cache '%(fname)s': %(msg)s" % {'fname' : fname, 'msg' : str(ex)})
+
+	def save(self):
+		'writes the cache into the file (write and rename)'
+
+		with self._lock:
+			data = json.dumps(self._entries)
+
+		write_atomic(self._fname, data)
+
+	def _stamps(self, env, pginfo=None):
+		'versions of the binaries the probe depends on (pg_config, postgres, compiler, pgxnclient)'
+
+		stamps = {'pg_config' : _stamp(which('pg_config', env)), 'pgxnclient' : _stamp(which('pgxnclient', env))}
+
+		if pginfo is not None:
+			stamps['postgres'] = _stamp(os.path.join(pginfo['BINDIR'], 'postgres'))
+			stamps['compiler'] = _stamp(which(pginfo.get('CC', 'cc').split()[0], env))
+
+		return stamps
+
+	def probe(self, env):
+		'''returns (pginfo, environment) of the PostgreSQL installation (the first pg_config in PATH), running the probes
+		only when the cached entry is missing or stale'''
+
+		pg_config_path = which('pg_config', env)
+
+		with self._lock:
+			entry = self._entries.get(pg_config_path)
+
+		if (entry is not None) and (entry['stamps'] == self._stamps(env, entry['pginfo'])):
+			return (entry['pginfo'], dict(entry['environment'], uname=_uname()))
+
+		logging.info("probing environment of '%(path)s'" % {'path' : pg_config_path})
+
+		pginfo = pg_config(env)
+
+		environment = {
+			'compiler' : _first_line([pginfo.get('CC', 'cc').split()[0], '--version'], env),
+			'pgxnclient' : _first_line(['pgxnclient', '--version'], env),
+			'python' : platform.python_version(),
+		}
+
+		with self._lock:
+			self._entries[pg_config_path] = {'stamps' : self._stamps(env, pginfo), 'pginfo' : pginfo, 'environment' : environment}
+
+		return (pginfo, dict(environment, uname=_uname()))
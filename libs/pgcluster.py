@@ -7,7 +7,17 @@ import StringIO
 import os
 import shutil
 import logging
-import tempfile
+import threading
+import hashlib
+import re
+
+from telemetry import metrics, span
+
+# serializes creation of the template data directories (workers may start at the same time)
+_template_lock = threading.Lock()
+
+# first PostgreSQL version supporting the option (the older ones refuse to start with an unknown option in the config)
+OPTION_VERSIONS = {'synchronous_commit' : (8, 3), 'full_page_writes' : (8, 1), 'shared_buffers' : (8, 2)}
 
 class PgClusterException(Exception):
 	pass
@@ -15,38 +25,148 @@ class PgClusterException(Exception):
 class PgCluster(object):
 	'encapsulates initdb and pg_ctl commands, to make the initialization, start and termination of PostgreSQL cluster easier'
 
-	def __init__(self, datadir, logdir):
-		'prepare a working cluster'
+	def __init__(self, datadir, logdir, port=None, socketdir=None, templatedir=None, bindir=None, settings=None, pginfo=None):
+		'''prepare a working cluster (using binaries from bindir, or from PATH), with settings overriding the defaults in
+		postgresql.conf (e.g. to disable fsync for throwaway clusters) - pginfo is the pg_config output, if already known'''
 		self._data = os.path.abspath(datadir)
 		self._logdir = os.path.abspath(logdir)
+		self._port = port
+		self._socketdir = socketdir
+		self._templatedir = templatedir
+		self._bindir = bindir
+		self._settings = settings or {}
+		self._pginfo = pginfo
+
+		if self._bindir is not None:
+			self._bindir = os.path.abspath(bindir)
+
+		if self._socketdir is not None:
+			self._socketdir = os.path.abspath(socketdir)
+
+		if self._templatedir is not None:
+			self._templatedir = os.path.abspath(templatedir)
 
 		if os.path.exists(datadir):
 			raise PgClusterException("data directory '%(dir)s' already exists" % {'dir' : datadir})
 
-	def _initdb(self):
+	def _initdb(self, datadir=None):
 		'initializes the PostgreSQL cluster, in the selected data directory (may fail for various reasons - e.g. existing directory, ...)'
 
-		logging.info("initializing cluster in '%(data)s' ..." % {'data' : self._data})
+		if datadir is None:
+			datadir = self._data
+
+		logging.info("initializing cluster in '%(data)s' ..." % {'data' : datadir})
 
 		logfile = open('%(dir)s/initdb.log' % {'dir' : self._logdir}, 'w')
-		r = subprocess.call(['initdb', '-D', self._data], stdout=logfile, stderr=logfile)
+
+		with span('initdb', datadir=datadir):
+			r = subprocess.call(['initdb', '-D', datadir], stdout=logfile, stderr=logfile, env=self.env())
 
 		if r != 0:
-			logging.critical("failed to initialize cluster in '%(data)s' (returned %(retval)d)" % {'data' : self._data, 'retval' : r})
+			logging.critical("failed to initialize cluster in '%(data)s' (returned %(retval)d)" % {'data' : datadir, 'retval' : r})
 			raise PgClusterException("initdb failed")
 
 		logging.info("cluster initialized OK")
 
+	def _fingerprint(self, info):
+		'''identifies the PostgreSQL binaries (pg_config output, size/mtime of the binaries) and initdb environment (locale),
+		so that a rebuilt installation does not reuse a stale template'''
+
+		digest = hashlib.sha256()
+
+		for k in sorted(info.keys()):
+			digest.update('%(key)s=%(value)s;' % {'key' : k, 'value' : info[k]})
+
+		for binary in ['initdb', 'postgres', 'pg_ctl']:
+			path = os.path.join(info['BINDIR'], binary)
+			if os.path.exists(path):
+				st = os.stat(path)
+				digest.update('%(path)s:%(size)d:%(mtime)d;' % {'path' : path, 'size' : st.st_size, 'mtime' : int(st.st_mtime)})
+
+		for var in ['LANG', 'LC_ALL', 'LC_COLLATE', 'LC_CTYPE', 'LC_MESSAGES', 'TZ']:
+			digest.update('%(var)s=%(value)s;' % {'var' : var, 'value' : os.environ.get(var, '')})
+
+		return digest.hexdigest()
+
+	def _template(self):
+		'''returns path to the template data directory for the current binaries, running initdb (only once) if needed - the
+		templates are stored in $templatedir/$installation/$fingerprint, stale templates of the installation get removed'''
+
+		info = self.info()
+
+		installdir = os.path.join(self._templatedir, hashlib.sha256(info['BINDIR']).hexdigest()[:16])
+		fingerprint = self._fingerprint(info)
+		template = os.path.join(installdir, fingerprint)
+
+		with _template_lock:
+
+			if os.path.isdir(template):
+				metrics.inc('pgxn_tester_cache_requests_total', {'cache' : 'templates', 'result' : 'hit'})
+				return template
+
+			metrics.inc('pgxn_tester_cache_requests_total', {'cache' : 'templates', 'result' : 'miss'})
+
+			# the binaries changed (or there's no template yet), so remove the stale templates
+			if os.path.isdir(installdir):
+				for d in os.listdir(installdir):
+					logging.info("removing stale template data directory '%(dir)s'" % {'dir' : os.path.join(installdir, d)})
+					shutil.rmtree(os.path.join(installdir, d), ignore_errors=True)
+			else:
+				os.makedirs(installdir)
+
+			# initdb into a temporary directory first, so that we never leave a half-initialized template behind
+			tmpdir = '%(dir)s.tmp-%(pid)d' % {'dir' : template, 'pid' : os.getpid()}
+
+			try:
+				self._initdb(tmpdir)
+				os.rename(tmpdir, template)
+			except:
+				shutil.rmtree(tmpdir, ignore_errors=True)
+				raise
+
+			logging.info("created template data directory '%(dir)s'" % {'dir' : template})
+
+		return template
+
+	def _clone_template(self):
+		'''initializes the data directory by copying the template (using reflinks when the filesystem supports them, falling
+		back to a regular copy - hardlinks are not an option as the files get modified in place)'''
+
+		template = self._template()
+
+		logging.info("copying template '%(template)s' into '%(data)s' ..." % {'template' : template, 'data' : self._data})
+
+		with span('clone template', datadir=self._data):
+
+			with open(os.devnull, 'w') as devnull:
+				r = subprocess.call(['cp', '-a', '--reflink=auto', template, self._data], stdout=devnull, stderr=devnull)
+
+			if r != 0:
+				logging.info("cp failed (returned %(retval)d), copying template using shutil" % {'retval' : r})
+				shutil.rmtree(self._data, ignore_errors=True)
+				shutil.copytree(template, self._data, symlinks=True)
+
+		logging.info("cluster initialized OK (from template)")
+
 	def start(self):
 		''
 
-		# initdb of the cluster
-		self._initdb()
+		# initdb of the cluster (or a copy of the template data directory)
+		if self._templatedir is not None:
+			self._clone_template()
+		else:
+			self._initdb()
+
+		# the overrides go into the data directory (not the template, that's shared by clusters with various settings)
+		if self._settings:
+			self._configure()
 
 		logging.info("starting cluster in '%(data)s' ..." % {'data' : self._data})
 
 		logfile = open('%(dir)s/startup.log' % {'dir' : self._logdir}, 'w')
-		r = subprocess.call(['pg_ctl', '-D', self._data, '-w', '-l', ('%(dir)s/postgres.log' % {'dir' : self._logdir}), 'start'], stdout=logfile, stderr=logfile)
+
+		with span('pg_ctl start', datadir=self._data):
+			r = subprocess.call(['pg_ctl', '-D', self._data, '-w', '-l', ('%(dir)s/postgres.log' % {'dir' : self._logdir})] + self._options() + ['start'], stdout=logfile, stderr=logfile, env=self.env())
 
 		if r != 0:
 			logging.critical("failed to start cluster in '%(data)s' (returned %(retval)d)" % {'data' : self._data, 'retval' : r})
@@ -54,12 +174,118 @@ class PgCluster(object):
 
 		logging.info("cluster started OK")
 
+	def settings(self):
+		'''the settings supported by the PostgreSQL version (options not known to the version are skipped) - this is what
+		gets appended to postgresql.conf'''
+
+		res = re.search('([0-9]+)\\.([0-9]+)', self.info().get('VERSION', ''))
+
+		version = (99, 99)
+		if res:
+			version = (int(res.group(1)), int(res.group(2)))
+
+		return dict([(k, v) for (k, v) in self._settings.items() if OPTION_VERSIONS.get(k, (0, 0)) <= version])
+
+	def _configure(self):
+		'appends the settings to postgresql.conf (the last value of an option wins)'
+
+		with open(os.path.join(self._data, 'postgresql.conf'), 'a') as conf:
+			conf.write("\n# overrides (pgxn-tester)\n")
+			for (k, v) in sorted(self.settings().items()):
+				conf.write("%(key)s = '%(value)s'\n" % {'key' : k, 'value' : v})
+
+	def _options(self):
+		'postmaster options passed through pg_ctl (port and socket directory, when not using the defaults)'
+
+		options = []
+
+		if self._port is not None:
+			options += ['-p', str(self._port)]
+
+		if self._socketdir is not None:
+			options += ['-k', self._socketdir]
+
+		if options:
+			return ['-o', ' '.join(options)]
+
+		return []
+
+	def env(self, base=None):
+		'environment for client tools (psql, createdb, pgxnclient, pg_regress ...) connecting to this cluster'
+
+		if base is None:
+			base = os.environ
+
+		env = dict(base)
+
+		if self._bindir is not None:
+			env['PATH'] = os.pathsep.join([self._bindir, env.get('PATH', '')])
+
+		if self._port is not None:
+			env['PGPORT'] = str(self._port)
+
+		if self._socketdir is not None:
+			env['PGHOST'] = self._socketdir
+
+		return env
+
+	def running(self):
+		'checks that the postmaster is still running (pg_ctl status)'
+
+		with open(os.devnull, 'w') as devnull:
+			r = subprocess.call(['pg_ctl', '-D', self._data, 'status'], stdout=devnull, stderr=devnull, env=self.env())
+
+		return (r == 0)
+
+	def pidfile(self):
+		'postmaster.pid of the cluster (identifies the postmaster)'
+
+		return os.path.join(self._data, 'postmaster.pid')
+
+	def log_position(self):
+		'current size of the server log (to inspect only messages logged after this point)'
+
+		try:
+			return os.path.getsize('%(dir)s/postgres.log' % {'dir' : self._logdir})
+		except OSError:
+			return 0
+
+	def crashed(self, position=0):
+		'looks for signs of a crash (backend killed by a signal, PANIC, crash recovery) in the server log since the position'
+
+		markers = ['terminated by signal', 'PANIC:', 'terminating any other active server processes', 'all server processes terminated; reinitializing']
+
+		with open('%(dir)s/postgres.log' % {'dir' : self._logdir}, 'r') as logfile:
+			logfile.seek(position)
+			for line in logfile:
+				for m in markers:
+					if line.find(m) >= 0:
+						return True
+
+		return False
+
+	def snapshot(self, dbname='template1'):
+		'''number of objects (relations, functions, types, schemas, operators) in the database - differences between
+		snapshots mean someone created (or dropped) objects there'''
+
+		query = "SELECT (SELECT count(*) FROM pg_class) || ',' || (SELECT count(*) FROM pg_proc) || ',' || (SELECT count(*) FROM pg_type) || ',' || (SELECT count(*) FROM pg_namespace) || ',' || (SELECT count(*) FROM pg_operator)"
+
+		process = subprocess.Popen(['psql', '-X', '-A', '-t', '-d', dbname, '-c', query], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env())
+		(out, err) = process.communicate()
+
+		if process.returncode != 0:
+			raise PgClusterException("psql failed: %(msg)s" % {'msg' : err.strip()})
+
+		return out.strip()
+
 	def _stop(self):
 
 		logging.info("stopping cluster in '%(data)s' ..." % {'data' : self._data})
 
 		logfile = open('%(dir)s/stop.log' % {'dir' : self._logdir}, 'w')
-		r = subprocess.call(['pg_ctl', '-D', self._data, 'stop'], stdout=logfile, stderr=logfile)
+
+		with span('pg_ctl stop', datadir=self._data):
+			r = subprocess.call(['pg_ctl', '-D', self._data, 'stop'], stdout=logfile, stderr=logfile, env=self.env())
 
 		if r != 0:
 			logging.critical("failed to stop cluster in '%(data)s' (returned %(retval)d)" % {'data' : self._data, 'retval' : r})
@@ -79,18 +305,28 @@ class PgCluster(object):
 			shutil.rmtree(self._data)
 
 	def info(self):
-		(logfile, filename) = tempfile.mkstemp()
+		'output of pg_config (as a dictionary), executed only once (unless passed to the constructor)'
 
-		r = subprocess.call(['pg_config'], stdout=logfile, stderr=logfile)
-		if r != 0:
-			raise PgClusterException("pg_config failed")
+		if self._pginfo is None:
+			self._pginfo = pg_config(self.env())
+
+		return self._pginfo
+
+
+def pg_config(env=None):
+	'runs pg_config (the first one in PATH), returns the output as a dictionary'
+
+	process = subprocess.Popen(['pg_config'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+	(out, err) = process.communicate()
+
+	if process.returncode != 0:
+		raise PgClusterException("pg_config failed: %(msg)s" % {'msg' : err.strip()})
 
-		logfile = open(filename, 'r')
-		lines = logfile.read().strip().split("\n")
-		info = {}
+	info = {}
 
-		for l in lines:
-			x = l.split('=')
-			info.update({x[0].strip() : x[1].strip()})
+	# the values may contain '=' too (e.g. CONFIGURE)
+	for l in out.strip().split("\n"):
+		(key, value) = l.split('=', 1)
+		info[key.strip()] = value.strip()
 
-		return info
+	return info
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+import glob
+import json
+import logging
+import operator
+import os
+import platform
+import re
+import threading
+import zipfile
+
+from pgxnclient.utils.semver import SemVer
+
+# version constraint - operator (none means '>=') and version ('8.4' gets cleaned into '8.4.0')
+CONSTRAINT = re.compile(r'^(>=|<=|==|!=|>|<|=)?\s*([0-9][0-9A-Za-z.\-]*)$')
+
+OPERATORS = {None : operator.ge, '>=' : operator.ge, '>' : operator.gt, '=' : operator.eq, '==' : operator.eq,
+			 '<=' : operator.le, '<' : operator.lt, '!=' : operator.ne}
+
+# names of the prerequisities (in PGXN META prereqs) with a special meaning
+POSTGRESQL = 'postgresql'
+PLATFORM = 'platform'
+
+# procedural languages available in all supported PostgreSQL versions (not extensions before 9.1)
+BUILTIN = ['plpgsql']
+
+def _version(value):
+	'SemVer of the (possibly not quite valid) version number'
+
+	try:
+		return SemVer(value)
+	except ValueError:
+		return SemVer(SemVer.clean(value))
+
+def compile_range(spec):
+	'''list of (operator, version) constraints of a version range (e.g. '>= 8.4.0, < 9.0.0'), an empty list means any
+	version ('0' in PGXN META) - invalid constraints are skipped'''
+
+	constraints = []
+
+	for c in [c.strip() for c in str(spec).split(',')]:
+
+		res = CONSTRAINT.match(c)
+
+		if not res:
+			logging.warning("skipping invalid prerequisity '%(constraint)s'" % {'constraint' : c})
+			continue
+
+		try:
+			version = _version(res.group(2))
+		except ValueError:
+			logging.warning("skipping invalid prerequisity '%(constraint)s'" % {'constraint' : c})
+			continue
+
+		# any version
+		if (res.group(1) is None) and (version == SemVer('0.0.0')):
+			continue
+
+		constraints.append((res.group(1), version))
+
+	return constraints
+
+def _matches(version, constraints):
+	'does the version satisfy all the constraints?'
+
+	for (op, v) in constraints:
+		if not OPERATORS[op](version, v):
+			return False
+
+	return True
+
+class Prerequisities(object):
+	'''compiled prerequisities of a distribution version - PostgreSQL version range, platforms and other extensions
+	(with version ranges), evaluated against the facts about an installation (see installation_facts)'''
+
+	def __init__(self, postgres=None, platforms=None, extensions=None):
+		self.postgres = postgres or []
+		self.platforms = platforms or []
+		self.extensions = extensions or {}
+
+	def check(self, facts):
+		'returns the reason why the prerequisities are not met, or None when the distribution can be tested'
+
+		if not _matches(facts['pgversion'], self.postgres):
+			return 'unmet PostgreSQL version (current %(version)s)' % {'version' : facts['pgversion']}
+
+		if self.platforms and (facts['platform'] not in self.platforms):
+			return 'unsupported platform (current %(platform)s, needs %(platforms)s)' % {'platform' : facts['platform'], 'platforms' : ', '.join(self.platforms)}
+
+		for (name, constraints) in sorted(self.extensions.items()):
+
+			# not provided by the installation, so it has to be installed from PGXN
+			if name not in facts['extensions']:
+				continue
+
+			version = facts['extensions'][name]
+
+			if (version is not None) and not _matches(version, constraints):
+				return 'unmet version of extension %(name)s (current %(version)s)' % {'name' : name, 'version' : version}
+
+		return None
+
+def compile_prereqs(prereqs):
+	'''compiles the prerequisities - either a list of PostgreSQL version ranges (as returned by the tester API), or the
+	"prereqs" object of PGXN META (phase => relationship => name => version range, only "requires" is enforced)'''
+
+	if isinstance(prereqs, dict):
+
+		postgres = []
+		platforms = []
+		extensions = {}
+
+		for phase in prereqs.values():
+			for (name, spec) in phase.get('requires', {}).items():
+
+				if name.lower() == POSTGRESQL:
+					postgres += compile_range(spec)
+				elif name.lower() == PLATFORM:
+					platforms += [p.strip().lower() for p in str(spec).split(',')]
+				else:
+					extensions.setdefault(name, []).extend(compile_range(spec))
+
+		return Prerequisities(postgres, platforms, extensions)
+
+	postgres = []
+
+	for prereq in (prereqs or []):
+		postgres += compile_range(prereq)
+
+	return Prerequisities(postgres)
+
+def installation_facts(installation):
+	'''what the PostgreSQL installation provides - version, platform and extensions (control files, and contrib modules
+	on versions without extensions) with their versions (None when unknown)'''
+
+	sharedir = installation['pginfo'].get('SHAREDIR', '')
+
+	extensions = dict([(name, None) for name in BUILTIN])
+
+	for fname in glob.glob(os.path.join(sharedir, 'contrib', '*.sql')):
+		extensions.setdefault(os.path.basename(fname)[:-4], None)
+
+	for fname in glob.glob(os.path.join(sharedir, 'extension', '*.control')):
+
+		version = None
+
+		try:
+			with open(fname, 'r') as f:
+				for line in f:
+					res = re.match(r"^\s*default_version\s*=\s*'([^']*)'", line)
+					if res:
+						version = _version(res.group(1))
+		except (IOError, ValueError):
+			pass
+
+		extensions[os.path.basename(fname)[:-8]] = version
+
+	return {'pgversion' : installation['pgversion'], 'platform' : platform.system().lower(), 'extensions' : extensions}
+
+# compiled prerequisities and results of the checks (the same prerequisities are checked for many distributions and
+# all the installations), shared by the prefetch threads
+_compiled = {}
+_results = {}
+_lock = threading.Lock()
+
+def _compile(prereqs):
+	'returns (key, compiled prerequisities) - each distinct set of prerequisities is compiled only once'
+
+	key = json.dumps(prereqs, sort_keys=True)
+
+	with _lock:
+		compiled = _compiled.get(key)
+
+	if compiled is None:
+		compiled = compile_prereqs(prereqs)
+		with _lock:
+			_compiled[key] = compiled
+
+	return (key, compiled)
+
+def check(prereqs, installation):
+	'''checks the prerequisities against the installation (with facts in installation['facts']), returns the reason why
+	the distribution can't be tested, or None - each distinct set of prerequisities is compiled and evaluated only once'''
+
+	(key, compiled) = _compile(prereqs)
+
+	result_key = (key, installation['pginfo']['BINDIR'])
+
+	with _lock:
+		if result_key in _results:
+			return _results[result_key]
+
+	reason = compiled.check(installation['facts'])
+
+	with _lock:
+		_results[result_key] = reason
+
+	return reason
+
+def required(prereqs):
+	'names of the extensions the distribution requires (except the procedural languages available everywhere)'
+
+	(key, compiled) = _compile(prereqs)
+
+	return sorted([name for name in compiled.extensions if name not in BUILTIN])
+
+def dependencies(prereqs, installation):
+	'''required extensions not provided by the installation (to be installed from PGXN), as a sorted list of (name, spec)
+	- the pgxnclient spec includes the version constraint, unless there are several (pgxnclient accepts just one)'''
+
+	(key, compiled) = _compile(prereqs)
+
+	deps = []
+
+	for (name, constraints) in sorted(compiled.extensions.items()):
+
+		if name in installation['facts']['extensions']:
+			continue
+
+		spec = name
+
+		if (len(constraints) == 1) and (constraints[0][0] != '!='):
+			spec = '%(name)s%(op)s%(version)s' % {'name' : name, 'op' : (constraints[0][0] or '>='), 'version' : constraints[0][1]}
+
+		deps.append((name, spec))
+
+	return deps
+
+def read_meta(archive):
+	'''"prereqs" object from META.json in the distribution archive (zip file, with everything in a single top-level
+	directory), or None when there's no (valid) META.json'''
+
+	try:
+		with zipfile.ZipFile(archive) as z:
+
+			names = [n for n in z.namelist() if (os.path.basename(n) == 'META.json') and (n.count('/') <= 1)]
+
+			if not names:
+				return None
+
+			meta = json.loads(z.read(min(names, key=len)))
+
+	except (IOError, zipfile.BadZipfile, ValueError):
+		return None
+
+	if not isinstance(meta, dict) or not isinstance(meta.get('prereqs'), dict):
+		return None
+
+	return meta['prereqs']
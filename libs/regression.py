@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+import os
+import re
+
+# header lines of the per-test diffs ('*** .../expected/x.out', '--- ...' or 'diff -U3 .../expected/x.out ...'), the
+# test name may have an alternative output suffix (x_1.out)
+HEADER = re.compile(r'^(\*\*\*|---|diff) .*?expected/([^/\s]+?)(_[0-9]+)?\.out')
+
+def find_diff(workdir, log=None):
+	'''path to regression.diffs of a failed check - pgxnclient copies it into the working directory (the build directory
+	gets removed), otherwise try the path printed by pg_regress into the log'''
+
+	fname = os.path.join(workdir, 'regression.diffs')
+
+	if os.path.exists(fname):
+		return fname
+
+	if log is not None:
+		res = log.search('"([^"]*.diffs)"')
+		if res and os.path.exists(res.group(1)):
+			return res.group(1)
+
+	return None
+
+def collect_diff(fname, limit=1048576):
+	'''streams the diff file, returns (text, summary) - the text is the first 'limit' bytes of the diff (with a marker
+	when truncated), the summary lists the failed tests with number of hunks, and is always computed from the whole file'''
+
+	tests = {}
+	test = None
+	hunks = 0
+	size = 0
+	body = []
+
+	with open(fname, 'rb') as f:
+		# very long lines are read in pieces
+		for line in iter(lambda: f.readline(65536), ''):
+
+			if size < limit:
+				body.append(line[:(limit - size)])
+
+			size += len(line)
+
+			res = HEADER.match(line)
+			if res:
+				test = res.group(2)
+				tests.setdefault(test, 0)
+				continue
+
+			# context diff (older pg_regress) or unified diff hunks
+			if line.startswith('***************') or line.startswith('@@ '):
+				hunks += 1
+				if test is not None:
+					tests[test] += 1
+
+	text = ''.join(body).decode('utf-8', 'replace')
+
+	if size > limit:
+		text += u"\n[truncated, %(size)d bytes total]\n" % {'size' : size}
+
+	summary = {'tests' : tests, 'hunks' : hunks, 'size' : size, 'truncated' : (size > limit)}
+
+	return (text, summary)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+import json
+import psutil
+import threading
+
+from utils import postmaster_process
+
+class ResourceSampler(threading.Thread):
+	'''samples resource usage of a test phase - the process tree of the command, and the processes of the test cluster
+	(backends are not children of the command, so they're not included in the rusage of the command)
+
+	The sampler tracks peak RSS and open file descriptors (summed over the processes), and CPU time and I/O of the
+	cluster processes (relative to the first sample, so that long-running processes of a warm cluster count only what
+	they did during the phase). CPU time and I/O of the command itself are best taken from wait4() rusage, which includes
+	short-lived descendants (e.g. compiler runs) the sampler would miss.'''
+
+	def __init__(self, pid, pidfile=None, interval=1.0):
+		super(ResourceSampler, self).__init__()
+		self.daemon = True
+		self._pid = pid
+		self._pidfile = pidfile
+		self._interval = interval
+		self._stopped = threading.Event()
+
+		self._max_rss = 0
+		self._max_fds = 0
+
+		# first and last seen (cpu_user, cpu_system, read_bytes, write_bytes) of the cluster processes
+		self._first = {}
+		self._last = {}
+
+		# processes not seen in the first sample were started during the phase
+		self._sampled = False
+
+	def _tree(self, p):
+
+		try:
+			return [p] + p.children(recursive=True)
+		except psutil.Error:
+			return []
+
+	def _counters(self, p):
+		'cumulative CPU time and I/O of the process'
+
+		cpu = p.cpu_times()
+
+		try:
+			io = p.io_counters()
+			(read_bytes, write_bytes) = (io.read_bytes, io.write_bytes)
+		except (psutil.Error, AttributeError, NotImplementedError):
+			(read_bytes, write_bytes) = (0, 0)
+
+		return (cpu.user, cpu.system, read_bytes, write_bytes)
+
+	def _sample(self):
+
+		rss = 0
+		fds = 0
+
+		try:
+			command = self._tree(psutil.Process(self._pid))
+		except psutil.Error:
+			command = []
+
+		postmaster = postmaster_process(self._pidfile)
+		cluster = []
+
+		if postmaster is not None:
+			cluster = self._tree(postmaster)
+
+		for p in command + cluster:
+			try:
+				rss += p.memory_info().rss
+				fds += p.num_fds()
+			except psutil.Error:
+				pass
+
+		for p in cluster:
+			try:
+				counters = self._counters(p)
+			except psutil.Error:
+				continue
+
+			# processes started during the phase count from zero
+			if p.pid not in self._first:
+				if self._sampled:
+					self._first[p.pid] = (0, 0, 0, 0)
+				else:
+					self._first[p.pid] = counters
+
+			self._last[p.pid] = counters
+
+		self._max_rss = max(self._max_rss, rss)
+		self._max_fds = max(self._max_fds, fds)
+
+		self._sampled = True
+
+	def run(self):
+
+		while True:
+
+			self._sample()
+
+			if self._stopped.wait(self._interval):
+				return
+
+	def stop(self):
+		'stop the sampling (and wait for the thread)'
+
+		self._stopped.set()
+		self.join()
+
+	def usage(self, rusage=None):
+		'''resource usage of the phase - with the rusage of the command (from wait4), the CPU time and I/O of the command
+		are added to those of the cluster processes'''
+
+		totals = [0, 0, 0, 0]
+
+		for (pid, last) in self._last.items():
+			first = self._first[pid]
+			for i in range(4):
+				totals[i] += max(0, last[i] - first[i])
+
+		usage = {'max_rss' : self._max_rss, 'max_fds' : self._max_fds, 'cpu_user' : totals[0], 'cpu_system' : totals[1], 'read_bytes' : totals[2], 'write_bytes' : totals[3]}
+
+		if rusage is not None:
+			usage['cpu_user'] += rusage.ru_utime
+			usage['cpu_system'] += rusage.ru_stime
+			usage['read_bytes'] += rusage.ru_inblock * 512
+			usage['write_bytes'] += rusage.ru_oublock * 512
+
+			# ru_maxrss (kB) is the peak of the largest single process, which may be above the sampled peak
+			usage['max_rss'] = max(usage['max_rss'], rusage.ru_maxrss * 1024)
+
+		usage['cpu_user'] = round(usage['cpu_user'], 3)
+		usage['cpu_system'] = round(usage['cpu_system'], 3)
+
+		return usage
+
+_metrics_lock = threading.Lock()
+
+def record_metrics(fname, record):
+	'appends the record (resource usage of a test) to the local metrics file, as a JSON line'
+
+	line = json.dumps(record, sort_keys=True)
+
+	with _metrics_lock:
+		with open(fname, 'a') as f:
+			f.write(line + "\n")
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+import threading
+import time
+
+class ResultSpool(object):
+	'''durable spool of results waiting for submission - each result is a separate JSON file, so results that were not
+	submitted survive a crash / restart and get submitted by the next run'''
+
+	def __init__(self, directory):
+		self._dir = os.path.abspath(directory)
+		self._rejected = os.path.join(self._dir, 'rejected')
+
+		for d in [self._dir, self._rejected]:
+			if not os.path.isdir(d):
+				os.makedirs(d)
+
+	def put(self, result):
+		'writes the result into the spool (fsync + rename, so that the file is either complete or missing)'
+
+		fname = os.path.join(self._dir, '%(time)d-%(uuid)s.json' % {'time' : int(time.time() * 1000), 'uuid' : result['uuid']})
+		tmpname = fname + '.tmp'
+
+		with open(tmpname, 'w') as f:
+			json.dump(result, f)
+			f.flush()
+			os.fsync(f.fileno())
+
+		os.rename(tmpname, fname)
+
+		return fname
+
+	def pending(self):
+		'spooled results, oldest first'
+
+		return sorted([os.path.join(self._dir, f) for f in os.listdir(self._dir) if f.endswith('.json')])
+
+	def load(self, fname):
+
+		with open(fname, 'r') as f:
+			return json.load(f)
+
+	def remove(self, fname):
+		'the result was submitted, so remove it from the spool'
+
+		os.remove(fname)
+
+	def reject(self, fname):
+		'the server refused the result - keep it aside for inspection, but do not retry it'
+
+		os.rename(fname, os.path.join(self._rejected, os.path.basename(fname)))
+
+
+class ResultSender(threading.Thread):
+	'''background thread submitting the spooled results - the send callback returns True (submitted), False (rejected
+	by the server) or None (failed, retry later), the results are sent in batches and retried every few seconds'''
+
+	def __init__(self, spool, send, interval=10, batch=20):
+		super(ResultSender, self).__init__(name='sender')
+		self.daemon = True
+		self._spool = spool
+		self._send = send
+		self._interval = interval
+		self._batch = batch
+		self._wakeup = threading.Event()
+		self._stopped = threading.Event()
+
+	def notify(self):
+		'a new result was spooled, submit it right away'
+
+		self._wakeup.set()
+
+	def submit(self, result):
+		'spools the result and wakes up the thread to submit it'
+
+		self._spool.put(result)
+		self.notify()
+
+	def flush(self, limit=None):
+		'submits (up to limit) spooled results, returns False if some of them failed and should be retried'
+
+		for fname in self._spool.pending()[:limit]:
+
+			try:
+				ok = self._send(self._spool.load(fname))
+			except Exception as ex:
+				logging.error("failed to submit spooled result '%(fname)s': %(msg)s" % {'fname' : fname, 'msg' : str(ex)})
+				ok = None
+
+			if ok is None:
+				# the API is not available, so don't bother with the remaining results
+				return False
+			elif ok:
+				self._spool.remove(fname)
+			else:
+				logging.error("result '%(fname)s' rejected by the server" % {'fname' : fname})
+				self._spool.reject(fname)
+
+		return True
+
+	def run(self):
+
+		while not self._stopped.is_set():
+
+			self._wakeup.wait(self._interval)
+			self._wakeup.clear()
+
+			# keep sending batches while the submissions succeed
+			while self.flush(self._batch) and self._spool.pending() and not self._stopped.is_set():
+				pass
+
+	def stop(self):
+		'stops the thread and tries to submit the remaining results (those that fail remain spooled for the next run)'
+
+		self._stopped.set()
+		self._wakeup.set()
+		self.join()
+
+		if not self.flush():
+			logging.warning("%(len)d result(s) remain spooled for the next run" % {'len' : len(self._spool.pending())})
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+import threading
+
+from utils import write_atomic
+
+class TestStats(object):
+	'''history of the tests (per distribution) - average duration of the install/load/check phases, number of timeouts
+	and failures, stored in a JSON file and used to schedule the tests'''
+
+	# weight of the new duration in the moving average
+	ALPHA = 0.3
+
+	def __init__(self, fname):
+		self._fname = fname
+		self._lock = threading.Lock()
+		self._stats = {}
+
+		if os.path.exists(fname):
+			try:
+				with open(fname, 'r') as f:
+					self._stats = json.load(f)
+			except Exception as ex:
+				logging.warning("failed to read test stats '%(fname)s': %(msg)s" % {'fname' : fname, 'msg' : str(ex)})
+
+	def save(self):
+		'writes the stats into the file (write and rename)'
+
+		with self._lock:
+			data = json.dumps(self._stats)
+
+		write_atomic(self._fname, data)
+
+	def record(self, distribution, result, timeout=False):
+		'updates the stats with the result of a test (durations in ms, timeout, failed phases)'
+
+		with self._lock:
+
+			stats = self._stats.setdefault(distribution, {'tests' : 0, 'timeouts' : 0, 'failures' : 0, 'install' : None, 'load' : None, 'check' : None})
+
+			stats['tests'] += 1
+
+			if 'error' in [result['install'], result['load'], result['check']]:
+				stats['failures'] += 1
+
+			# phases that did not run have no duration
+			phases = [phase for phase in ['install', 'load', 'check'] if result[phase] != 'unknown']
+
+			if timeout:
+				stats['timeouts'] += 1
+
+				# the phase that timed out (the last one) took at least as long as the timeout, so the next timeout is
+				# a multiple of that (otherwise a phase that legitimately takes longer would time out on every run)
+				if phases:
+					phase = phases.pop()
+					stats[phase] = max(stats[phase] or 0, result[phase + '_duration'])
+
+			for phase in phases:
+
+				duration = result[phase + '_duration']
+
+				if stats[phase] is None:
+					stats[phase] = duration
+				else:
+					stats[phase] = int((1 - self.ALPHA) * stats[phase] + self.ALPHA * duration)
+
+	def expected(self, distribution, phase=None):
+		'expected duration (ms) of the test (or just a phase), None if there is no history'
+
+		with self._lock:
+
+			stats = self._stats.get(distribution)
+
+			if stats is None:
+				return None
+
+			if phase is not None:
+				return stats[phase]
+
+			return sum([stats[p] or 0 for p in ['install', 'load', 'check']])
+
+	def timeouts(self, distribution):
+		'number of timeouts of the distribution'
+
+		with self._lock:
+			return self._stats.get(distribution, {}).get('timeouts', 0)
+
+	def timeout(self, distribution, phase, minimum, factor, maximum):
+		'timeout of the phase (seconds) - a multiple of the expected duration, within the minimum/maximum limits'
+
+		expected = self.expected(distribution, phase)
+
+		if expected is None:
+			return minimum
+
+		return int(max(minimum, min(maximum, factor * expected / 1000.0)))
+
+	def priority(self, distribution, default=60000):
+		'''scheduling priority - longest expected test first (so that the long tests don't end up last on a single worker),
+		distributions that timed out before are tested last'''
+
+		if self.timeouts(distribution) > 0:
+			return -1
+
+		expected = self.expected(distribution)
+
+		if expected is None:
+			return default
+
+		return expected
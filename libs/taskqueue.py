@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+import threading
+
+class TaskQueue(object):
+	'''queue of tasks shared by the worker threads - never hands out two tasks with the same key at the same time (e.g. two
+	versions of the same distribution, which would be installed into the same PostgreSQL installation), and hands out the
+	task with the highest priority first (tasks with the same priority in FIFO order)
+
+	tasks may also belong to groups (e.g. distributions sharing dependencies) - a worker keeps taking tasks from its
+	current group, and the other workers prefer tasks from groups nobody is working on (if there are any)'''
+
+	def __init__(self, key=None, priority=None, group=None):
+		self._cond = threading.Condition()
+		self._tasks = []
+		self._active = set()
+		self._groups = {}
+		self._closed = False
+		self._key = key
+		self._priority = priority
+		self._group = group
+
+		if self._key is None:
+			self._key = lambda task: task
+
+		if self._priority is None:
+			self._priority = lambda task: 0
+
+		if self._group is None:
+			self._group = lambda task: None
+
+	def put(self, task):
+		'add a task at the end of the queue'
+
+		priority = self._priority(task)
+
+		with self._cond:
+			self._tasks.append((priority, task))
+			self._cond.notify_all()
+
+	def close(self, discard=False):
+		'''no more tasks will be added - get() returns None once the queue is drained (or right away, when discarding the
+		tasks not handed out yet)'''
+
+		with self._cond:
+			self._closed = True
+			if discard:
+				self._tasks = []
+			self._cond.notify_all()
+
+	def _rank(self, task, group):
+		'2 for tasks of the preferred group, 0 for tasks of groups other workers are working on, 1 otherwise'
+
+		g = self._group(task)
+
+		if g is None:
+			return 1
+		elif g == group:
+			return 2
+		elif self._groups.get(g, 0) > 0:
+			return 0
+
+		return 1
+
+	def _next(self, group=None):
+		'index of the highest-ranked (and then highest-priority) task not conflicting with the active ones (or None)'
+
+		best = None
+
+		for (idx, (priority, task)) in enumerate(self._tasks):
+			if self._key(task) in self._active:
+				continue
+			rank = (self._rank(task, group), priority)
+			if (best is None) or (rank > best[0]):
+				best = (rank, idx)
+
+		if best is None:
+			return None
+
+		return best[1]
+
+	def get(self, group=None):
+		'''returns the next runnable task (preferring tasks of the group), waits if all the remaining tasks conflict with
+		running ones (None means we are done)'''
+
+		with self._cond:
+			while True:
+
+				idx = self._next(group)
+
+				if idx is not None:
+					(priority, task) = self._tasks.pop(idx)
+					self._active.add(self._key(task))
+					g = self._group(task)
+					if g is not None:
+						self._groups[g] = self._groups.get(g, 0) + 1
+					return task
+
+				if self._closed and not self._tasks:
+					return None
+
+				self._cond.wait()
+
+	def done(self, task):
+		'mark the task as completed (tasks with the same key may be handed out again)'
+
+		with self._cond:
+			self._active.discard(self._key(task))
+			g = self._group(task)
+			if g is not None:
+				self._groups[g] -= 1
+			self._cond.notify_all()
+
+	def __len__(self):
+
+		with self._cond:
+			return len(self._tasks)
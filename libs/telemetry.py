@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+import BaseHTTPServer
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+class Tracer(object):
+	'''writes spans (name, start, duration, thread, attributes) into a file - either as JSON lines, or in the Chrome trace
+	event format (JSON array, which may be left unterminated, so it's fine to simply append the events)'''
+
+	def __init__(self, fname, fmt='jsonl'):
+		self._lock = threading.Lock()
+		self._format = fmt
+		self._file = open(fname, 'w')
+
+		if self._format == 'chrome':
+			self._file.write("[\n")
+
+	def write(self, name, start, duration, attrs):
+
+		if self._format == 'chrome':
+			event = {'name' : name, 'ph' : 'X', 'ts' : int(start * 1000000), 'dur' : int(duration * 1000000), 'pid' : os.getpid(),
+					 'tid' : threading.current_thread().name, 'args' : attrs}
+			line = json.dumps(event) + ",\n"
+		else:
+			event = {'name' : name, 'start' : start, 'duration' : duration, 'thread' : threading.current_thread().name, 'attrs' : attrs}
+			line = json.dumps(event) + "\n"
+
+		with self._lock:
+			self._file.write(line)
+			self._file.flush()
+
+	def close(self):
+
+		with self._lock:
+			self._file.close()
+
+class Metrics(object):
+	'''counters, histograms and gauges (callables evaluated when rendered), rendered in the Prometheus text format'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._histograms = {}
+		self._gauges = {}
+		self._started = time.time()
+
+	def _key(self, name, labels):
+		return (name, tuple(sorted((labels or {}).items())))
+
+	def inc(self, name, labels=None, value=1):
+
+		key = self._key(name, labels)
+
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + value
+
+	def observe(self, name, value, labels=None):
+
+		key = self._key(name, labels)
+
+		with self._lock:
+			histogram = self._histograms.setdefault(key, {'buckets' : [0] * len(BUCKETS), 'count' : 0, 'sum' : 0.0})
+			for (idx, bound) in enumerate(BUCKETS):
+				if value <= bound:
+					histogram['buckets'][idx] += 1
+			histogram['count'] += 1
+			histogram['sum'] += value
+
+	def gauge(self, name, func):
+		'registers a gauge, the function gets called whenever the metrics are rendered'
+
+		with self._lock:
+			self._gauges[name] = func
+
+	def uptime(self):
+		return time.time() - self._started
+
+	def total(self, name):
+		'sum of the counter over all the labels'
+
+		with self._lock:
+			return sum([v for ((n, labels), v) in self._counters.items() if n == name])
+
+	def _format(self, name, labels, value, extra=None):
+
+		labels = list(labels) + list(extra or [])
+
+		if not labels:
+			return '%(name)s %(value)s' % {'name' : name, 'value' : value}
+
+		labels = ','.join(['%(k)s="%(v)s"' % {'k' : k, 'v' : str(v).replace('\\', '\\\\').replace('"', '\\"').replace("\n", '\\n')} for (k, v) in labels])
+
+		return '%(name)s{%(labels)s} %(value)s' % {'name' : name, 'labels' : labels, 'value' : value}
+
+	def render(self):
+
+		with self._lock:
+			counters = sorted(self._counters.items())
+			histograms = sorted([(k, dict(v, buckets=list(v['buckets']))) for (k, v) in self._histograms.items()])
+			gauges = sorted(self._gauges.items())
+
+		lines = []
+
+		for ((name, labels), value) in counters:
+			lines.append(self._format(name, labels, value))
+
+		for ((name, labels), histogram) in histograms:
+			for (idx, bound) in enumerate(BUCKETS):
+				lines.append(self._format(name + '_bucket', labels, histogram['buckets'][idx], [('le', bound)]))
+			lines.append(self._format(name + '_bucket', labels, histogram['count'], [('le', '+Inf')]))
+			lines.append(self._format(name + '_count', labels, histogram['count']))
+			lines.append(self._format(name + '_sum', labels, histogram['sum']))
+
+		for (name, func) in gauges:
+			try:
+				lines.append(self._format(name, [], func()))
+			except Exception as ex:
+				logging.debug("failed to evaluate gauge '%(name)s': %(msg)s" % {'name' : name, 'msg' : str(ex)})
+
+		return "\n".join(lines) + "\n"
+
+class MetricsServer(threading.Thread):
+	'serves the metrics over HTTP (GET /metrics), for long-running clients'
+
+	def __init__(self, metrics, port, host='127.0.0.1'):
+		super(MetricsServer, self).__init__(name='metrics')
+		self.daemon = True
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+			def do_GET(self):
+
+				if self.path != '/metrics':
+					self.send_error(404)
+					return
+
+				body = metrics.render()
+
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self._server = BaseHTTPServer.HTTPServer((host, port), Handler)
+
+	def run(self):
+		self._server.serve_forever()
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+# shared by all the modules (the metrics are always collected, the trace only when configured)
+metrics = Metrics()
+_tracer = None
+
+def configure_trace(fname, fmt='jsonl'):
+	'starts writing the spans into the file (JSON lines or Chrome trace format)'
+
+	global _tracer
+	_tracer = Tracer(fname, fmt)
+
+def close_trace():
+
+	global _tracer
+
+	if _tracer is not None:
+		_tracer.close()
+		_tracer = None
+
+@contextlib.contextmanager
+def span(name, **attrs):
+	'''measures duration of the block - writes the span into the trace (if enabled) and into the latency histogram of the
+	span (the block may add attributes to the yielded dictionary, e.g. the result)'''
+
+	start = time.time()
+
+	try:
+		yield attrs
+	except:
+		attrs['error'] = True
+		raise
+	finally:
+		duration = time.time() - start
+
+		metrics.observe('pgxn_tester_span_seconds', duration, {'span' : name})
+
+		tracer = _tracer
+		if tracer is not None:
+			try:
+				tracer.write(name, start, duration, attrs)
+			except Exception as ex:
+				logging.warning("failed to write span '%(name)s': %(msg)s" % {'name' : name, 'msg' : str(ex)})
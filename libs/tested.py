@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+import threading
+import time
+
+from utils import write_atomic
+
+class TestedCache(object):
+	'''set of (distribution, version) pairs already tested on this machine / PostgreSQL version, fetched from the API in
+	a few paged requests and cached on disk (for a limited time)'''
+
+	def __init__(self, fname, ttl=3600):
+		self._fname = fname
+		self._ttl = ttl
+		self._lock = threading.Lock()
+		self._tested = set()
+
+		# when the set was fetched from the API (the TTL counts from then, not from the last save)
+		self._timestamp = None
+
+	def load(self):
+		'loads the cached set from disk, returns False if there is no cache file or it expired'
+
+		if not os.path.exists(self._fname):
+			return False
+
+		try:
+			with open(self._fname, 'r') as f:
+				data = json.load(f)
+		except Exception as ex:
+			logging.warning("failed to read cache of tested distributions '%(fname)s': %(msg)s" % {'fname' : self._fname, 'msg' : str(ex)})
+			return False
+
+		if time.time() - data['timestamp'] > self._ttl:
+			logging.info("cache of tested distributions '%(fname)s' expired" % {'fname' : self._fname})
+			return False
+
+		with self._lock:
+			self._tested = set([tuple(v) for v in data['tested']])
+			self._timestamp = data['timestamp']
+
+		logging.info("loaded %(len)d tested distributions from '%(fname)s'" % {'len' : len(self._tested), 'fname' : self._fname})
+
+		return True
+
+	def save(self):
+		'''writes the set into the cache file (write and rename, so that readers never see a partial file), keeping the time
+		of the last fetch (a set that was never fetched gets refetched on the next load)'''
+
+		with self._lock:
+			data = {'timestamp' : (self._timestamp or 0), 'tested' : sorted(self._tested)}
+
+		write_atomic(self._fname, json.dumps(data))
+
+	def fetch(self, api, uri, page_size=1000):
+		'''fetches all results for the machine / PostgreSQL version (the uri), using limit/offset paging - stops on a short
+		page, or when a page does not add anything new (i.e. the server ignores the paging)'''
+
+		tested = set()
+		offset = 0
+		timestamp = time.time()
+
+		while True:
+
+			results = api.get('%(uri)s&limit=%(limit)d&offset=%(offset)d' % {'uri' : uri, 'limit' : page_size, 'offset' : offset})
+
+			before = len(tested)
+			tested.update([(r['distribution'], r['version']) for r in results])
+
+			if (len(results) < page_size) or (len(tested) == before):
+				break
+
+			offset += len(results)
+
+		with self._lock:
+			self._tested = tested
+			self._timestamp = timestamp
+
+		logging.info("fetched %(len)d tested distributions from the API" % {'len' : len(tested)})
+
+	def add(self, distribution, version):
+		'marks the distribution version as tested (e.g. after submitting the result)'
+
+		with self._lock:
+			self._tested.add((distribution, version))
+
+	def __contains__(self, item):
+
+		with self._lock:
+			return (tuple(item) in self._tested)
@@ -1,21 +1,48 @@
 import hashlib
+import logging
+import os
+import psutil
+import signal
+import threading
+
+from diagnostics import collect_diagnostics
+
+# chunk size used when hashing file-like values
+SIGN_CHUNK_SIZE = 65536
+
+def _update_digest(digest, value):
+	'''feeds the value into the digest - file-like values are read in chunks (and rewound), strings are hashed directly
+	(without a copy), everything else as str(value)'''
+
+	if hasattr(value, 'read'):
+		position = value.tell()
+		for chunk in iter(lambda: value.read(SIGN_CHUNK_SIZE), ''):
+			digest.update(chunk)
+		value.seek(position)
+	elif isinstance(value, str):
+		digest.update(value)
+	else:
+		digest.update(str(value))
+
+def compute_signature(data, secret):
+	'''signature of the data (the same as sign_request, but does not modify the data) - values may be file-like objects,
+	hashed incrementally with the same result as if the contents were passed as a string'''
 
-def sign_request(data, secret):
-	'simple JSON signing with a shared secret'
-
-	keys = data.keys()
 	digest = hashlib.sha256()
 	digest.update(secret)
 
-	keys = sorted(data.keys())
-
-	for k in keys:
+	for k in sorted(data.keys()):
 		digest.update(k)
 		digest.update(':')
-		digest.update(str(data[k]))
+		_update_digest(digest, data[k])
 		digest.update(';')
 
-	data.update({'signature' : digest.hexdigest()})
+	return digest.hexdigest()
+
+def sign_request(data, secret):
+	'simple JSON signing with a shared secret'
+
+	data.update({'signature' : compute_signature(data, secret)})
 
 	return data
 
@@ -25,65 +52,112 @@ def verify_signature(data, secret, signature):
 	return (sign_request(data, secret) == signature)
 
 
+def postmaster_process(pidfile):
+	'postmaster of the test cluster (psutil.Process, from the postmaster.pid file), or None if not running'
+
+	if (pidfile is None) or (not os.path.exists(pidfile)):
+		return None
+
+	try:
+		with open(pidfile, 'r') as f:
+			return psutil.Process(int(f.readline().strip()))
+	except Exception:
+		return None
+
+def write_atomic(fname, data):
+	'''writes the string into the file (creating the directory if needed) - write and rename, so that readers never see
+	a partial file'''
+
+	dirname = os.path.dirname(fname)
+	if dirname and not os.path.isdir(dirname):
+		os.makedirs(dirname)
+
+	tmpname = '%(fname)s.%(pid)d' % {'fname' : fname, 'pid' : os.getpid()}
+
+	with open(tmpname, 'w') as f:
+		f.write(data)
+
+	os.rename(tmpname, fname)
+
+
 class TimeoutKiller(threading.Thread):
-	
-	def __init__(self, timeout=300):
+	'''watchdog for a single command (started in its own process group) - when the command does not finish within the
+	timeout, collects diagnostics (see collect_diagnostics) and kills the process group and the postmaster of the test
+	cluster (identified by the postmaster.pid file), but nothing else, so it's safe to use with concurrent workers'''
+
+	def __init__(self, process, timeout=300, pidfile=None, env=None, budget=10):
 		super(TimeoutKiller, self).__init__()
+		self.daemon = True
 		self._lock = threading.Lock()
-		self._stop = False
-		self._timeout = 300
-		self._start = time.time()
+		self._stopped = threading.Event()
+		self._process = process
+		self._timeout = timeout
+		self._pidfile = pidfile
+		self._env = env
+		self._budget = budget
+		self._expired = False
+		self._diagnostics = None
 
-	def stopped(self):
-		'checks state of the _stop flag (with proper locking to get the last value)'
-
-		self._lock.acquire()
-		stopped = (self._stop)
-		self._lock.release()
+	def stop(self):
+		'the command finished, so wake up the thread and let it end'
 
-		return stopped
+		self._stopped.set()
 
-	def stop(self):
-		'ask the thread to stop (with proper locking to make sure the thread sees the new value)'
+	def expired(self):
+		'did the timeout expire (i.e. were the processes killed)?'
 
 		self._lock.acquire()
-		self._stop = True
+		expired = (self._expired)
 		self._lock.release()
 
-	def run(self):
-
-		# repeat until we get 'stop' request from the parent process, or 
-		while (not self.stopped()):
+		return expired
 
-			# sleep for a second (to re-evaluate the stop variable)
-			time.sleep(1)
+	def diagnostics(self):
+		'diagnostics collected before killing the processes (None if the timeout did not expire)'
 
-			# we've exceeded the timeout, let's kill 'em all
-			if (time.time() - self._start) > self._timeout:
+		self._lock.acquire()
+		diagnostics = self._diagnostics
+		self._lock.release()
 
-				logging.warning("timeout expired, printing backtraces ...")
+		return diagnostics
 
-				self._print_bt()
+	def run(self):
 
-				logging.warning("check timed out, killing all remaining postgres processes ...")
+		# wait until the command finishes (the parent calls stop) or the timeout expires
+		self._stopped.wait(self._timeout)
 
-				# find all 'postgres' processes and murder them with 'kill -9'
-				subprocess.call(['killall', '-9', 'postgres'], stdout=open('/dev/null', 'w'), stderr=open('/dev/null', 'w'))
+		if self._stopped.is_set():
+			return
 
-				# we did what we had to do, so end the thread
-				return
+		self._lock.acquire()
+		self._expired = True
+		self._lock.release()
 
-	def _print_bt(self):
+		postmaster = postmaster_process(self._pidfile)
 
-		# find all postgres processes, run gdb on them
-		for p in psutil.process_iter():
-			if p.name() == 'postgres':
+		logging.warning("timeout (%(timeout)d s) expired, collecting diagnostics ..." % {'timeout' : self._timeout})
 
-				print "process pid=",str(p.pid),"cmdline=",str(p.cmdline()),"meminfo",p.memory_info(),"fds=",p.num_fds()
+		try:
+			diagnostics = collect_diagnostics(self._process, postmaster, env=self._env, budget=self._budget)
+		except Exception as ex:
+			diagnostics = {'error' : str(ex)}
 
-				with open('gdb.log', 'w') as tmp_file:
-					subprocess.call(['gdb', '-p', str(p.pid), '-ex', 'bt', '--batch'], stdout=tmp_file, stderr=tmp_file)
+		self._lock.acquire()
+		self._diagnostics = diagnostics
+		self._lock.release()
 
-				with open('gdb.log', 'r') as tmp_file:
-					print "===== back trace ====="
-					print tmp_file.read()
+		logging.warning("timeout expired, killing the command and the cluster processes ...")
+
+		# the command (and everything it started, e.g. make and pg_regress) runs in its own process group
+		try:
+			os.killpg(self._process.pid, signal.SIGKILL)
+		except OSError:
+			pass
+
+		# backends first, then the postmaster (so that it can't start new ones)
+		if postmaster is not None:
+			for p in (postmaster.children(recursive=True) + [postmaster]):
+				try:
+					p.kill()
+				except psutil.Error:
+					pass
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+import Queue
+
+# where to download the PostgreSQL sources from
+SOURCE_URL = 'http://ftp.postgresql.org/pub/source/v%(version)s/postgresql-%(version)s.tar.bz2'
+
+# directories with ccache masquerade symlinks (gcc, cc, ... wrapped by ccache) on the common distributions
+CCACHE_DIRS = ['/usr/lib/ccache', '/usr/lib64/ccache', '/usr/local/opt/ccache/libexec']
+
+def parse_cmdline():
+	'''command-line parameter parser'''
+
+	parser = argparse.ArgumentParser(description='PGXN Tester Client - PostgreSQL builds')
+
+	parser.add_argument('--pg-dir', dest='pgdir', default='./pg', help='directory with the PostgreSQL installations (default: ./pg)')
+	parser.add_argument('--build-dir', dest='builddir', default='./builds', help='directory for the builds and their logs (default: ./builds)')
+	parser.add_argument('--cache-dir', dest='cachedir', default='./cache', help='directory for locally cached data, e.g. downloaded tarballs (default: ./cache)')
+	parser.add_argument('--options', dest='options', default='', help='configure options (a change rebuilds all the versions)')
+	parser.add_argument('--cpus', dest='cpus', type=int, default=multiprocessing.cpu_count(), help='total number of CPUs used by the builds (default: all CPUs)')
+	parser.add_argument('--parallel', dest='parallel', type=int, default=None, help='number of versions built concurrently (default: up to 4, within the CPU budget)')
+	parser.add_argument('--no-ccache', dest='no_ccache', action='store_true', default=False, help='do not use ccache, even if available (default: false)')
+	parser.add_argument('--force', dest='force', action='store_true', default=False, help='rebuild all the versions, even those up to date (default: false)')
+	parser.add_argument('--debug', dest='debug', action='store_true', default=False, help='debug output (default: false)')
+
+	parser.add_argument('versions', nargs='+', help='PostgreSQL versions to build')
+
+	return parser.parse_args()
+
+
+def init_logging(debug=False):
+
+	# by default, we're logging just INFO and above
+	level=logging.INFO
+
+	if debug:
+		level=logging.DEBUG
+
+	logging.basicConfig(level=level, format='%(asctime)-15s %(levelname)s [%(threadName)s] %(message)s')
+
+
+def sha1_file(fname):
+
+	digest = hashlib.sha1()
+
+	with open(fname, 'rb') as f:
+		for chunk in iter(lambda: f.read(65536), ''):
+			digest.update(chunk)
+
+	return digest.hexdigest()
+
+
+def ccache_dir():
+	'directory with the ccache compiler wrappers (to put at the beginning of PATH), or None if ccache is not installed'
+
+	for d in CCACHE_DIRS:
+		if os.path.isdir(d):
+			return d
+
+	return None
+
+
+def fetch_tarball(version, cachedir):
+	'''returns path to the source tarball of the version, downloading it only if not cached yet (written into a temporary
+	file first, so that an interrupted download is never mistaken for a tarball)'''
+
+	tarball = os.path.join(cachedir, 'postgresql-%(version)s.tar.bz2' % {'version' : version})
+
+	if os.path.exists(tarball):
+		return tarball
+
+	url = SOURCE_URL % {'version' : version}
+	tmpname = '%(fname)s.%(pid)d' % {'fname' : tarball, 'pid' : os.getpid()}
+
+	logging.info("downloading '%(url)s'" % {'url' : url})
+
+	try:
+		response = urllib2.urlopen(url, timeout=60)
+
+		with open(tmpname, 'wb') as f:
+			shutil.copyfileobj(response, f, 65536)
+
+		os.rename(tmpname, tarball)
+
+	finally:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+
+	return tarball
+
+
+def build_stamp(tarball, options):
+	'identifies the build - the tarball contents and configure options (the build is redone only when it changes)'
+
+	return {'tarball' : sha1_file(tarball), 'options' : options}
+
+
+def up_to_date(prefix, stamp):
+	'is the installation in prefix complete and built from the same tarball/options?'
+
+	fname = os.path.join(prefix, '.build-stamp')
+
+	if not os.path.exists(fname) or not os.path.exists(os.path.join(prefix, 'bin', 'pg_config')):
+		return False
+
+	try:
+		with open(fname, 'r') as f:
+			return (json.load(f) == stamp)
+	except Exception:
+		return False
+
+
+def run_step(name, command, cwd, logfile, env):
+	'runs a build step, with output in the log file (raises an exception on failure)'
+
+	start_time = time.time()
+
+	with open(logfile, 'w') as log:
+		r = subprocess.call(command, cwd=cwd, stdout=log, stderr=log, env=env)
+
+	if r != 0:
+		raise Exception("%(name)s failed (returned %(retval)d, see '%(log)s')" % {'name' : name, 'retval' : r, 'log' : logfile})
+
+	logging.info("  %(name)s completed (%(duration).1f s)" % {'name' : name, 'duration' : (time.time() - start_time)})
+
+
+def build_version(version, args, jobs, ccache):
+	'''builds and installs a single PostgreSQL version (unless up to date) - the new build is installed into a stage
+	directory (DESTDIR) and moved into place only when complete, so a failed rebuild keeps the previous installation'''
+
+	pgdir = os.path.abspath(args.pgdir)
+	builddir = os.path.abspath(args.builddir)
+	prefix = os.path.join(pgdir, version)
+
+	tarball = fetch_tarball(version, os.path.join(os.path.abspath(args.cachedir), 'tarballs'))
+	stamp = build_stamp(tarball, args.options)
+
+	if not args.force and up_to_date(prefix, stamp):
+		logging.info("PostgreSQL %(version)s is up to date" % {'version' : version})
+		return prefix
+
+	logging.info("building PostgreSQL %(version)s (make -j%(jobs)d)" % {'version' : version, 'jobs' : jobs})
+
+	env = dict(os.environ)
+
+	if ccache is not None:
+		env['PATH'] = os.pathsep.join([ccache, env.get('PATH', '')])
+
+	# always build from a freshly extracted tree (ccache makes the recompilation cheap)
+	srcdir = os.path.join(builddir, 'postgresql-%(version)s' % {'version' : version})
+	stagedir = os.path.join(builddir, 'stage-%(version)s' % {'version' : version})
+
+	for d in [srcdir, stagedir]:
+		shutil.rmtree(d, ignore_errors=True)
+
+	log = lambda step: os.path.join(builddir, '%(step)s-%(version)s.log' % {'step' : step, 'version' : version})
+
+	try:
+		run_step('extract', ['tar', '-xjf', tarball], builddir, log('unpack'), env)
+	except:
+		# probably a corrupted tarball, download it again next time
+		os.remove(tarball)
+		raise
+
+	run_step('configure', ['./configure'] + args.options.split() + ['--prefix=%(prefix)s' % {'prefix' : prefix}], srcdir, log('config'), env)
+	run_step('make', ['make', '-j%(jobs)d' % {'jobs' : jobs}, 'install', 'DESTDIR=%(dir)s' % {'dir' : stagedir}], srcdir, log('make'), env)
+	run_step('make install (contrib)', ['make', '-j%(jobs)d' % {'jobs' : jobs}, 'install', 'DESTDIR=%(dir)s' % {'dir' : stagedir}], os.path.join(srcdir, 'contrib'), log('make-contrib'), env)
+
+	with open(os.path.join(stagedir + prefix, '.build-stamp'), 'w') as f:
+		json.dump(stamp, f)
+
+	# replace the previous installation (if any)
+	shutil.rmtree(prefix, ignore_errors=True)
+	shutil.move(stagedir + prefix, prefix)
+
+	for d in [srcdir, stagedir]:
+		shutil.rmtree(d, ignore_errors=True)
+
+	logging.info("PostgreSQL %(version)s built OK" % {'version' : version})
+
+	return prefix
+
+
+def register_installations(pgdir, prefixes):
+	'''writes the list of pg_config paths of the installations into $pgdir/installations (used by run-tests.sh to pick
+	the installations to test), write and rename'''
+
+	fname = os.path.join(pgdir, 'installations')
+	tmpname = '%(fname)s.%(pid)d' % {'fname' : fname, 'pid' : os.getpid()}
+
+	with open(tmpname, 'w') as f:
+		for prefix in prefixes:
+			f.write(os.path.join(prefix, 'bin', 'pg_config') + "\n")
+
+	os.rename(tmpname, fname)
+
+	logging.info("registered %(len)d installations in '%(fname)s'" % {'len' : len(prefixes), 'fname' : fname})
+
+
+class BuildWorker(threading.Thread):
+	'builds the versions from the queue (the number of workers limits the number of concurrent builds)'
+
+	def __init__(self, pending, results, args, jobs, ccache):
+		super(BuildWorker, self).__init__()
+		self.daemon = True
+		self._pending = pending
+		self._results = results
+		self._args = args
+		self._jobs = jobs
+		self._ccache = ccache
+
+	def run(self):
+
+		while True:
+
+			try:
+				version = self._pending.get_nowait()
+			except Queue.Empty:
+				return
+
+			try:
+				self._results[version] = build_version(version, self._args, self._jobs, self._ccache)
+			except Exception as ex:
+				logging.error("build of PostgreSQL %(version)s failed: %(msg)s" % {'version' : version, 'msg' : str(ex)})
+				self._results[version] = None
+
+
+if __name__ == '__main__':
+
+	args = parse_cmdline()
+
+	init_logging(args.debug)
+
+	for d in [args.pgdir, args.builddir, os.path.join(args.cachedir, 'tarballs')]:
+		if not os.path.isdir(d):
+			os.makedirs(d)
+
+	ccache = None
+	if not args.no_ccache:
+		ccache = ccache_dir()
+		if ccache is None:
+			logging.warning("ccache not found, building without it")
+
+	# split the CPU budget between the concurrent builds
+	parallel = max(1, min(len(args.versions), args.parallel or 4, args.cpus))
+	jobs = max(1, args.cpus / parallel)
+
+	logging.info("building %(len)d versions, %(parallel)d at a time (make -j%(jobs)d)" % {'len' : len(args.versions), 'parallel' : parallel, 'jobs' : jobs})
+
+	pending = Queue.Queue()
+
+	for version in args.versions:
+		pending.put(version)
+
+	results = {}
+	workers = [BuildWorker(pending, results, args, jobs, ccache) for i in range(parallel)]
+
+	for worker in workers:
+		worker.start()
+
+	for worker in workers:
+		worker.join()
+
+	# register the installations available for testing (in the order of the versions)
+	prefixes = [results[v] for v in args.versions if results.get(v) is not None]
+
+	register_installations(os.path.abspath(args.pgdir), prefixes)
+
+	failed = [v for v in args.versions if results.get(v) is None]
+
+	if failed:
+		logging.error("failed to build PostgreSQL %(versions)s" % {'versions' : ', '.join(failed)})
+		sys.exit(1)
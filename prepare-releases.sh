@@ -12,69 +12,11 @@ PGOPTIONS="--enable-cassert --with-perl --with-python --with-tcl --with-libxml -
 
 PGDIR="$DIR/pg"
 BUILDDIR="$DIR/builds"
+CACHEDIR="$DIR/cache"
 
-# start from scratch (remove old builds, compile from scratch)
-rm -Rf $PGDIR $BUILDDIR
-mkdir -p $PGDIR $BUILDDIR
-
-# number of CPUs (for parallel make)
+# number of CPUs (shared by the parallel builds)
 CPUS=`cat /proc/cpuinfo  | grep 'processor' | wc -l`
 
-for version in $VERSIONS; do
-
-	cd $BUILDDIR
-
-	echo "building PostgreSQL $version"
-
-	wget http://ftp.postgresql.org/pub/source/v$version/postgresql-$version.tar.bz2 > download-$version.log 2>&1
-
-	if [ "$?" != "0" ]; then
-		echo "  download failed :-("
-		exit 1
-	fi
-
-	echo "  downloaded ;-)"
-
-	tar -xjf postgresql-$version.tar.bz2 > unpack-$version.log 2>&1
-
-	if [ "$?" != "0" ]; then
-		echo "  extract failed :-("
-		exit 1
-	fi
-
-	echo "  extracted ;-)"
-
-	cd postgresql-$version
-
-	./configure $PGOPTIONS --prefix=$PGDIR/$version > ../config-$version.log 2>&1
-
-	if [ "$?" != "0" ]; then
-		echo "  configure failed :-("
-		exit 1
-	fi
-
-	echo "  configured ;-)"
-
-	make -j$CPUS install > ../make-$version.log 2>&1
-
-	if [ "$?" != "0" ]; then
-		echo "  make failed :-("
-		exit 1
-	fi
-
-	echo "  make completed ;-)"
-
-	cd ./contrib
-
-	make -j$CPUS install > ../make-contrib-$version.log 2>&1
-
-	if [ "$?" != "0" ]; then
-		echo "  make install (contrib) failed :-("
-		exit 1
-	fi
-
-	echo "  make install (contrib) completed ;-)"
-
-	echo "  build completed OK"
-
-done
\ No newline at end of file
+# builds the versions in parallel (only those with a new tarball or changed options), using ccache and cached tarballs,
+# and registers the installations in $PGDIR/installations (for run-tests.sh)
+$DIR/prepare-releases.py --pg-dir "$PGDIR" --build-dir "$BUILDDIR" --cache-dir "$CACHEDIR" --cpus $CPUS --options "$PGOPTIONS" $VERSIONS
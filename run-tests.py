@@ -1,19 +1,20 @@
 #!/usr/bin/env python
 
 import argparse
-import httplib
 import json
 import os.path
-import re
 import shutil
+import signal
 import subprocess
 import sys
 import time
 import uuid
 import StringIO
-import codecs
+import errno
 import base64
 import psutil
+import tempfile
+import Queue
 
 from pgxnclient import Spec
 from pgxnclient.utils.semver import SemVer
@@ -25,6 +26,19 @@ sys.path.append('libs')
 
 from pgcluster import PgCluster
 from utils import sign_request, TimeoutKiller
+from taskqueue import TaskQueue
+from api import ApiClient
+from tested import TestedCache
+from spool import ResultSpool, ResultSender
+from capture import CapturedLog
+from artifacts import ArtifactCache, ArtifactCacheException, fingerprint, install_copy
+from downloads import DownloadCache
+from stats import TestStats
+from environment import EnvironmentCache
+from regression import find_diff, collect_diff
+import prereqs
+from resources import ResourceSampler, record_metrics
+from telemetry import metrics, span, configure_trace, close_trace, MetricsServer
  
 import threading
 import time
@@ -34,11 +48,38 @@ def parse_cmdline():
 
 	parser = argparse.ArgumentParser(description='PGXN Tester Client')
 
+	parser.add_argument('--pg-config', dest='pgconfig', action='append', default=None, help='pg_config (or bin directory) of a PostgreSQL installation to test, may be repeated (default: pg_config in PATH)')
 	parser.add_argument('--data-dir', dest='datadir', default='./data', help='PostgreSQL data directory (default: ./data).')
 	parser.add_argument('--log-dir', dest='logdir', default=('logs/' + datetime.now().strftime('%Y%m%d-%H%M%S')), help='log directory (default: ./logs/YYYYmmdd-H24MS)')
 	parser.add_argument('--api', dest='api', default='api.pgxn-tester.org', help='API URI (default: api.pgxn-tester.org).')
+	parser.add_argument('--timeout', dest='timeout', type=int, default=300, help='minimum timeout of each phase (install/load/check) in seconds (default: 300)')
+	parser.add_argument('--timeout-factor', dest='timeout_factor', type=float, default=5.0, help='timeout as a multiple of the expected duration of the phase (default: 5)')
+	parser.add_argument('--max-timeout', dest='max_timeout', type=int, default=3600, help='maximum timeout of each phase in seconds (default: 3600)')
+	parser.add_argument('--log-limit', dest='log_limit', type=int, default=4194304, help='maximum size of a submitted log in bytes, larger logs are truncated to head/tail (default: 4MB)')
+	parser.add_argument('--diff-limit', dest='diff_limit', type=int, default=1048576, help='maximum size of a submitted regression diff in bytes, larger diffs are truncated (default: 1MB)')
+	parser.add_argument('--no-compress', dest='no_compress', action='store_true', default=False, help='do not gzip-compress the submitted results (default: false)')
+	parser.add_argument('--trace', dest='trace', default=None, help='write spans (API calls, initdb, pg_ctl, test phases, uploads) into this file, disabled by default')
+	parser.add_argument('--trace-format', dest='trace_format', choices=['jsonl', 'chrome'], default='jsonl', help='format of the trace - JSON lines, or Chrome trace events (default: jsonl)')
+	parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=None, help='serve metrics in Prometheus format on http://127.0.0.1:PORT/metrics, disabled by default')
 	parser.add_argument('--debug', dest='debug', action='store_true', default=False, help='debug output (default: false)')
 
+	parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='number of distributions tested in parallel, each on a separate cluster (default: 1)')
+	parser.add_argument('--port', dest='port', type=int, default=None, help='port of the (first) PostgreSQL cluster, workers use consecutive ports (default: 5432)')
+	parser.add_argument('--prefetch', dest='prefetch', type=int, default=4, help='number of concurrent API requests when fetching details about the queued distributions (default: 4)')
+	parser.add_argument('--warm-cluster', dest='warm', action='store_true', default=False, help='keep the cluster running between distributions, rebuild it only when a test breaks it (default: false)')
+	parser.add_argument('--rebuild-after', dest='rebuild', type=int, default=50, help='rebuild the warm cluster after this number of tests (default: 50)')
+	parser.add_argument('--cache-dir', dest='cachedir', default='./cache', help='directory for locally cached data (default: ./cache)')
+	parser.add_argument('--build-cache-size', dest='artifact_cache_size', type=int, default=0, help='size limit of the cache of built distributions in MB, 0 disables the cache (default: 0)')
+	parser.add_argument('--spool-dir', dest='spooldir', default='./spool', help='directory with results waiting for submission (default: ./spool)')
+	parser.add_argument('--tested-ttl', dest='tested_ttl', type=int, default=3600, help='how long to trust the cached list of already tested distributions, in seconds (default: 3600)')
+	parser.add_argument('--profile', dest='profile', choices=['default', 'fast'], default='default', help='cluster profile - "fast" disables fsync (and other durability options) and places the data directory on tmpfs if there is enough memory (default: default)')
+	parser.add_argument('--tmpfs-dir', dest='tmpfs_dir', default='/dev/shm', help='tmpfs directory for data directories of the "fast" profile (default: /dev/shm)')
+	parser.add_argument('--tmpfs-min', dest='tmpfs_min', type=int, default=1024, help='free space (and available memory) needed to place a data directory on tmpfs, in MB (default: 1024)')
+	parser.add_argument('--template-dir', dest='templatedir', default=None, help='directory with template data directories (initdb once per PostgreSQL build, then copy), disabled by default')
+
+	parser.add_argument('--daemon', dest='daemon', action='store_true', default=False, help='keep running (with the caches and warm clusters), polling the queue for new distributions (default: false)')
+	parser.add_argument('--poll-interval', dest='poll_interval', type=int, default=30, help='how often to poll the queue in daemon mode, in seconds (default: 30)')
+
 	parser.add_argument('--distribution', dest='distribution', default=None, help='distribution to test')
 	parser.add_argument('--version', dest='version', default=None, help='version to test (only with distribution)')
 
@@ -48,166 +89,375 @@ def parse_cmdline():
 	return parser.parse_args()
 
 
-def get_data(host, uri, retries=3, delay=20):
+def get_data(api, uri):
 	'''GET requests (with retries), returns JSON object'''
 
-	while (retries > 0):
-		retries -= 1
+	try:
+		return api.get(uri)
+	except Exception as ex:
+		logging.error("attempt to get data from '%(uri)s' failed: %(msg)s" % {'msg' : str(ex), 'uri' : uri})
 
-		try:
 
-			conn = httplib.HTTPConnection(host)
-			conn.request("GET", uri)
-			response = conn.getresponse().read()
+def get_uri_templates(api, prefix):
+	'''returns URI templates (JSON dictionary)'''
 
-			return json.loads(response)
+	templates = get_data(api, prefix)
 
-		except Exception as ex:
-			logging.warning("attempt to get data from '%(host)s' '%(uri)s' failed: %(msg)s" % {'msg' : str(ex), 'host' : host, 'uri' : uri})
-			time.sleep(delay)
+	for k in templates:
+		templates[k] = (prefix+templates[k])
 
-		finally:
-			conn.close()
+	return templates
 
-	logging.error("attempt to get data from '%(host)s' '%(uri)s' failed: %(msg)s" % {'msg' : str(ex), 'host' : host, 'uri' : uri})
 
+# the queue entries handed out so far (per installation) are updated by the poller and the worker threads
+_seen_lock = threading.Lock()
 
-def get_uri_templates(host, prefix):
-	'''returns URI templates (JSON dictionary)'''
+def get_distributions(api, templates, installation, args):
+	'''returns list of distributions (packages) added to the queue of the installation since the previous call - uses
+	a conditional request, so polling an unchanged queue costs just a "304 Not Modified" response'''
 
-	templates = get_data(host, prefix)
+	uri = templates['queue'].replace('{name}', args.name).replace('{version}', installation['pgversion'])
 
-	for k in templates:
-		templates[k] = (prefix+templates[k])
+	(distributions, installation['validators']) = api.get_modified(uri, installation.get('validators'))
+
+	# not modified, but entries that did not get tested (see forget_distribution) are handed out again
+	if distributions is None:
+		distributions = installation.get('queue', [])
+
+	installation['queue'] = distributions
+
+	# check if testing only a specified distribution (and version)
+	if args.distribution is not None:
+		distributions = [d for d in distributions if d['name'] == args.distribution]
+
+		if args.version is not None:
+			distributions = [d for d in distributions if d['version'] == args.version]
+
+	# remember the current contents of the queue (not everything ever seen, the queue may be long-running)
+	with _seen_lock:
+		seen = installation.get('seen', set())
+		installation['seen'] = set([(d['name'], d['version']) for d in distributions])
+
+	return [d for d in distributions if (d['name'], d['version']) not in seen]
 
-	return templates
 
+def forget_distribution(name, version, installation):
+	'''the queued distribution did not end with a spooled result (failed prefetch, failed test, missing dependency), so
+	hand it out again on the next poll of the queue (daemon mode)'''
 
-def get_distributions(host, templates, machine, pgversion):
-	'''returns list of distributions (packages)'''
+	with _seen_lock:
+		installation.get('seen', set()).discard((name, version))
 
-	uri = templates['queue'].replace('{name}', machine).replace('{version}', pgversion)
-	return get_data(host, uri)
 
+def enqueue_distributions(pending, api, templates, installations, args):
+	'''fetches new distributions from the queues of all the installations, and adds them to the pending queue (interleaved,
+	so that all the PostgreSQL versions make progress), returns the number of added distributions'''
 
-def get_distribution_version(host, templates, dist, version):
+	queues = []
+
+	for installation in installations:
+
+		distributions = get_distributions(api, templates, installation, args)
+
+		if distributions:
+			logging.info("received list of %(len)d distributions to test on %(name)s (PostgreSQL %(version)s)" % {'len' : len(distributions), 'name' : args.name, 'version' : installation['pgversion']})
+
+		queues.append([(dist, installation) for dist in distributions])
+
+	for i in range(max([len(q) for q in queues] + [0])):
+		for q in queues:
+			if i < len(q):
+				pending.put(q[i])
+
+	return sum([len(q) for q in queues])
+
+
+def get_distribution_version(api, templates, dist, version):
 	'''returns list of versions for the given distribution'''
 
 	uri = (templates['version'].replace('{name}', dist)).replace('{version}', version)
-	return get_data(host, uri)
+	return get_data(api, uri)
 
 
-def post_results(host, templates, results, retries=3, delay=20):
-	'''posts the result back to the tester server'''
+# details of the distribution versions (the same for all PostgreSQL versions, so fetch them only once)
+_details = {}
+_details_lock = threading.Lock()
 
-	# post the results (retru in case of failure)
-	while (retries > 0):
-		retries -= 1
-		try:
+def get_distribution_details(api, templates, dist, version):
+	'''get_distribution_version, fetching each distribution version only once'''
 
-			conn = httplib.HTTPConnection(host)
-			conn.request("POST", templates['results'], json.dumps(results), {"Content-type": "application/json"})
-			response = conn.getresponse()
+	with _details_lock:
+		if (dist, version) in _details:
+			return _details[(dist, version)]
 
-			return (response.status, json.loads(response.read()))
+	details = get_distribution_version(api, templates, dist, version)
+
+	if details is not None:
+		with _details_lock:
+			_details[(dist, version)] = details
+
+	return details
 
-		except Exception as ex:
 
-			logging.warning("attempt to submit result failed: %(msg)s" % {'msg' : str(ex)})
-			time.sleep(delay)
+def post_results(api, templates, results):
+	'''posts the result back to the tester server, returns (status, response) - the status is -1 when the request failed
+	(connection errors, 5xx responses even after the retries)'''
 
+	# post the results (the client retries in case of failure, the result remains spooled if that does not help)
 	try:
-		logging.error("attempt to submit results failed: %(request)s" % {'request' : json.dumps(results, indent=True)})
+		return api.post(templates['results'], results)
 	except Exception as ex:
-		# it might have failed for utf8 issues or whatever, so log the results as text
-		logging.error("attempt to submit results failed: %(request)s" % {'request' : results})
-		logging.error("can't log the results as JSON: %(msg)s" % {'msg' : str(ex)})
+		logging.warning("attempt to submit result '%(uuid)s' failed: %(msg)s" % {'uuid' : results['uuid'], 'msg' : str(ex)})
 
 	# send something sensible (-1 does not clash with HTTP codes)
 	return (-1, "failed to execute POST request")
 
-def check_prerequisities(pgversion, prereqs):
-	'verifies requirements on PostgreSQL version'
-
-	for prereq in prereqs:
-		tmp = [v.strip() for v in prereq.split(',')]
-		for r in tmp:
-			res = re.match('(>|>=|=|==|<=|<)?(\s+)?([0-9]+\.[0-9]+\.[0-9]+)', r)
-			if res:
-				operator = res.group(1)
-				version = SemVer(res.group(3))
-
-				if (operator is None) or (operator == '>='):
-					if not (pgversion >= version):
-						return False
-				elif (operator == '=') or (operator == '=='):
-					if not (pgversion == version):
-						return False
-				elif (operator == '>'):
-					if not (pgversion > version):
-						return False
-				elif (operator == '>='):
-					if not (pgversion >= version):
-						return False
-				elif (operator == '<'):
-					if not (pgversion < version):
-						return False
-				elif (operator == '<='):
-					if not (pgversion <= version):
-						return False
-				else:
-					print "unknown operator in prerequisity:",r
 
-			else:
-				print "skipping invalid prerequisity :",r
+def installation_for(result, installations):
+	'PostgreSQL installation the result was produced on (matching the version in the config), or None'
+
+	version = json.loads(result['config']).get('VERSION')
+
+	for installation in installations:
+		if installation['pginfo']['VERSION'] == version:
+			return installation
+
+	return None
+
+
+def submit_result(result, api, templates, installations):
+	'''submits a spooled result (called from the sender thread) - returns True when accepted, False when rejected by the
+	server and None when the request failed (and should be retried later)'''
 
-	return True
+	# do the POST request (if OK, status is 200)
+	with span('upload', distribution=result['distribution'], version=result['version']) as attrs:
+		(status, reason) = post_results(api, templates, result)
+		attrs['status'] = status
 
-def already_tested_on(host, templates, machine, pgversion, distribution, version):
-	'checks whether the distribution/version was already tested on this machine'
+	if (status == 200):
+		installation = installation_for(result, installations)
+		if installation is not None:
+			installation['tested'].add(result['distribution'], result['version'])
+		logging.info("POST OK : UUID='%(uuid)s' install=%(install)s load=%(load)s check=%(check)s" % {'uuid' : reason['uuid'], 'install' : result['install'], 'load' : result['load'], 'check' : result['check']})
+		return True
 
-	uri = templates['results'] + '?' + '&'.join(['machine=' + machine, 'pg_version=' + pgversion, 'distribution=' + distribution, 'version=' + version])
+	# error pages may be long (and not JSON)
+	logging.error(str(reason)[:1024])
+	logging.error("POST for %(dist)s-%(version)s failed (status = %(status)d)" % {'dist' : result['distribution'], 'version' : result['version'], 'status' : status})
 
-	results = get_data(host, uri)
+	if status == -1:
+		return None
 
-	# if at least one result returned, then already tested
-	return (len(results) != 0)
+	# any other status is the final answer of the server (retrying would not change it, and the result would block the
+	# results spooled after it)
+	return False
 
-def run_command(command, log_fname):
+def get_tested(api, templates, machine, pgversion, cachedir, ttl):
+	'''returns (distribution, version) pairs already tested on this machine / PostgreSQL version - from the on-disk cache
+	if it's fresh enough, otherwise from the API (a few paged requests instead of one request per queued distribution)'''
 
-	with open(log_fname, 'w') as logfile:
+	fname = os.path.join(cachedir, 'tested-%(machine)s-%(pgversion)s.json' % {'machine' : machine, 'pgversion' : pgversion})
+	tested = TestedCache(fname, ttl=ttl)
+
+	if not tested.load():
+		uri = templates['results'] + '?' + '&'.join(['machine=' + machine, 'pg_version=' + pgversion])
+		tested.fetch(api, uri)
+		tested.save()
+
+	return tested
+
+def run_command(command, log_fname, env=None, log_limit=4194304, append=False, timeout=None, pidfile=None, cwd=None):
+	'''runs the command with output captured in the log file (not read into memory, see CapturedLog) - with a timeout,
+	the command runs in its own process group, killed (along with the cluster in pidfile) by TimeoutKiller
+
+	returns (retval, log, duration, hang, usage), where hang are diagnostics of the timed-out command (None if it finished)
+	and usage is the resource usage of the command and the cluster in pidfile (see ResourceSampler)'''
+
+	with open(log_fname, ('a' if append else 'w')) as logfile:
 		start_time = time.time()
-		r = subprocess.call(command, stdout=logfile, stderr=logfile)
+
+		process = subprocess.Popen(command, stdout=logfile, stderr=logfile, env=env, cwd=cwd, preexec_fn=os.setsid)
+
+		killer = None
+		if timeout is not None:
+			killer = TimeoutKiller(process, timeout=timeout, pidfile=pidfile, env=env)
+			killer.start()
+
+		sampler = ResourceSampler(process.pid, pidfile=pidfile)
+		sampler.start()
+
+		# wait4 (instead of process.wait) to get rusage of the command, including the descendants it waited for
+		while True:
+			try:
+				(pid, status, rusage) = os.wait4(process.pid, 0)
+				break
+			except OSError as ex:
+				if ex.errno != errno.EINTR:
+					raise
+
+		if os.WIFSIGNALED(status):
+			r = -os.WTERMSIG(status)
+		else:
+			r = os.WEXITSTATUS(status)
+
+		process.returncode = r
+
+		# we're done, stop the timer
+		hang = None
+		if killer is not None:
+			killer.stop()
+			killer.join()
+			hang = killer.diagnostics()
+
+		sampler.stop()
+
 		duration = int(1000 * (time.time() - start_time))
 
-	with codecs.open(log_fname, 'r', encoding='utf-8') as logfile:
-		log = logfile.read()
+	return (r, CapturedLog(log_fname, limit=log_limit), duration, hang, sampler.usage(rusage))
+
+def install_cached(release, version, archive, log_fname, env, log_limit, artifacts, fingerprint, timeout=None):
+	'''install phase using the build cache - on a hit, the cached files are simply copied into the PostgreSQL installation,
+	otherwise the archive is installed into a DESTDIR stage directory (which is then cached), returns (retval, log, hang, usage)'''
+
+	key = artifacts.key(fingerprint, release, version)
+
+	if artifacts.lookup(key):
+
+		logging.info("installing '%(release)s-%(version)s' from the build cache" % {'release' : release, 'version' : version})
+
+		try:
+			artifacts.install(key, log_fname)
+
+			with open(log_fname, 'a') as logfile:
+				logfile.write("\n[installed from the build cache]\n")
+
+			return (0, CapturedLog(log_fname, limit=log_limit), None, {})
+
+		except ArtifactCacheException as ex:
+			# evicted since the lookup, so do the actual build
+			logging.warning("%(msg)s, building '%(release)s-%(version)s'" % {'msg' : str(ex), 'release' : release, 'version' : version})
+
+	stagedir = tempfile.mkdtemp(prefix='stage-', dir=env.get('TMPDIR'))
+
+	try:
+
+		# make install honors DESTDIR from the environment
+		stage_env = dict(env)
+		stage_env['DESTDIR'] = stagedir
+
+		(r, log, duration, hang, usage) = run_command(['pgxnclient', 'install', archive], log_fname, env=stage_env, log_limit=log_limit, append=True, timeout=timeout)
+
+		if r != 0:
+			return (r, log, hang, usage)
+
+		# makefiles ignoring DESTDIR install the files directly, so there's nothing to cache
+		if not os.listdir(stagedir):
+			logging.warning("'%(release)s-%(version)s' ignores DESTDIR, not caching the build" % {'release' : release, 'version' : version})
+			return (r, log, hang, usage)
+
+		artifacts.store(key, release, version, stagedir, log_fname)
+		install_copy(stagedir)
+
+		return (r, log, hang, usage)
+
+	finally:
+		shutil.rmtree(stagedir, ignore_errors=True)
+
+# dependencies installed into the PostgreSQL installations - (bindir, name) => (installed, time), with a lock for each,
+# so that the dependency is installed only once even when needed by multiple workers at the same time
+_dependencies = {}
+_dependency_locks = {}
+_dependencies_lock = threading.Lock()
+
+# failed installs (e.g. PGXN not available) are retried after this many seconds, not right away by each dependent
+DEPENDENCY_RETRY = 300
 
-	return (r, log, duration)
+def install_dependency(name, spec, installation, env, log_limit=4194304, timeout=None):
+	'''installs the dependency (extension required by the tested distributions) from PGXN into the installation, only
+	once per installation (workers needing the dependency wait for the first one), returns True when it's installed - a
+	failure is remembered only for DEPENDENCY_RETRY seconds'''
 
-def test_release(release, version, state, logdir):
-	'''this does all the testing heavy-lifting - calls pgxnclient with install/load/check and records the output'''
+	key = (installation['pginfo']['BINDIR'], name)
+
+	with _dependencies_lock:
+		lock = _dependency_locks.setdefault(key, threading.Lock())
+
+	with lock:
+
+		if key in _dependencies:
+
+			(installed, timestamp) = _dependencies[key]
+
+			if installed or (time.time() - timestamp < DEPENDENCY_RETRY):
+				metrics.inc('pgxn_tester_dependencies_total', {'result' : 'reused'})
+				return installed
+
+		logging.info("installing dependency '%(spec)s' into PostgreSQL %(version)s" % {'spec' : spec, 'version' : installation['pgversion']})
+
+		log_fname = '%(dir)s/dependency-%(name)s-install.log' % {'dir' : installation['logdir'], 'name' : name}
+
+		with span('dependency', distribution=name, spec=spec) as attrs:
+			(r, log, duration, hang, usage) = run_command(['pgxnclient', 'install', spec], log_fname, env=env, log_limit=log_limit, timeout=timeout)
+			attrs['retval'] = r
+
+		if r != 0:
+			logging.warning("failed to install dependency '%(spec)s' (see '%(log)s')" % {'spec' : spec, 'log' : log_fname})
+
+		metrics.inc('pgxn_tester_dependencies_total', {'result' : ('installed' if r == 0 else 'failed')})
+
+		_dependencies[key] = ((r == 0), time.time())
+
+		return (r == 0)
+
+def test_release(release, version, state, logdir, downloads, env=None, dbname='pgxntest', log_limit=4194304, artifacts=None, fingerprint=None, timeouts=None, pidfile=None, diff_limit=1048576, extensions=None):
+	'''this does all the testing heavy-lifting - calls pgxnclient with install/load/check and records the output (each
+	phase is protected by a timeout, in seconds, killing the command and the cluster in pidfile), the extensions the
+	distribution requires get created in the fresh database first'''
+
+	if timeouts is None:
+		timeouts = {'install' : 300, 'load' : 300, 'check' : 300}
 
 	state_opt = ('--%(state)s' % {'state' : state})
-	result = {'distribution' : release, 'version' : version, 'install' : 'unknown', 'load' : 'unknown', 'check' : 'unknown', 'check_diff' : '', 'check_log' : '',  'install_log' : '', 'load_log' : '', 'install_duration' : 0, 'check_duration' : 0, 'load_duration' : 0}
+	result = {'distribution' : release, 'version' : version, 'install' : 'unknown', 'load' : 'unknown', 'check' : 'unknown', 'check_diff' : '', 'check_diff_summary' : {}, 'check_log' : '',  'install_log' : '', 'load_log' : '', 'install_duration' : 0, 'check_duration' : 0, 'load_duration' : 0, 'timeout' : False, 'diagnostics' : {}, 'resources' : {}}
 
 	# INITIALIZATION (dropdb/createdb)
 
 	log_fname = '%(dir)s/%(release)s-%(version)s-init.log' % {'dir' : logdir, 'release' : release, 'version' : version}
 
-	with open(log_fname, 'w') as logfile:
-		r = subprocess.call(['dropdb', 'pgxntest'], stdout=logfile, stderr=logfile)
-		r = subprocess.call(['createdb', 'pgxntest'], stdout=logfile, stderr=logfile)
-		r = subprocess.call(['createuser', '-s', 'postgres'], stdout=logfile, stderr=logfile)
+	with open(log_fname, 'w') as logfile, span('createdb', distribution=release, version=version):
+		r = subprocess.call(['dropdb', dbname], stdout=logfile, stderr=logfile, env=env)
+		r = subprocess.call(['createdb', dbname], stdout=logfile, stderr=logfile, env=env)
+		r = subprocess.call(['createuser', '-s', 'postgres'], stdout=logfile, stderr=logfile, env=env)
+
+		# the extensions are installed (once per installation), but the database is new for each distribution
+		for name in (extensions or []):
+			r = subprocess.call(['psql', '-d', dbname, '-c', ('CREATE EXTENSION IF NOT EXISTS "%(name)s"' % {'name' : name.replace('"', '""')})], stdout=logfile, stderr=logfile, env=env)
 
 	# INSTALL
 
 	log_fname = '%(dir)s/%(release)s-%(version)s-install.log' % {'dir' : logdir, 'release' : release, 'version' : version}
 
-	(r, logtext, duration) = run_command(['pgxnclient', 'install', state_opt, '%(release)s=%(version)s' % {'release' : release, 'version' : version}], log_fname)
+	start_time = time.time()
+
+	# the archive is downloaded only once, and then used by all the phases (and PostgreSQL versions)
+	with span('download', distribution=release, version=version):
+		spec = downloads.fetch(release, version, state_opt, log_fname, env=env)
+
+	with span('install', distribution=release, version=version) as attrs:
+		if spec is None:
+			(r, logtext, hang, usage) = (1, CapturedLog(log_fname, limit=log_limit), None, {})
+		elif artifacts is not None:
+			(r, logtext, hang, usage) = install_cached(release, version, spec, log_fname, env or os.environ, log_limit, artifacts, fingerprint, timeout=timeouts['install'])
+		else:
+			(r, logtext, duration, hang, usage) = run_command(['pgxnclient', 'install', spec], log_fname, env=env, log_limit=log_limit, append=True, timeout=timeouts['install'])
+		attrs['retval'] = r
+
+	result['timeout'] = (hang is not None)
+	result['diagnostics'] = (hang or {})
 
 	result['install_log'] = logtext
-	result['install_duration'] = duration
+	result['resources']['install'] = usage
+	result['install_duration'] = int(1000 * (time.time() - start_time))
 
 	if r != 0:
 		result['install'] = 'error'
@@ -219,9 +469,15 @@ def test_release(release, version, state, logdir):
 
 	log_fname = '%(dir)s/%(release)s-%(version)s-load.log' % {'dir' : logdir, 'release' : release, 'version' : version}
 
-	(r, logtext, duration) = run_command(['pgxnclient', 'load', '-U', 'postgres', '-d', 'pgxntest', state_opt, '--yes', '%(release)s=%(version)s' % {'release' : release, 'version' : version}], log_fname)
+	with span('load', distribution=release, version=version) as attrs:
+		(r, logtext, duration, hang, usage) = run_command(['pgxnclient', 'load', '-U', 'postgres', '-d', dbname, state_opt, '--yes', spec], log_fname, env=env, log_limit=log_limit, timeout=timeouts['load'], pidfile=pidfile)
+		attrs['retval'] = r
+
+	result['timeout'] = (hang is not None)
+	result['diagnostics'] = (hang or {})
 
 	result['load_log'] = logtext
+	result['resources']['load'] = usage
 	result['load_duration'] = duration
 
 	if r != 0:
@@ -232,18 +488,34 @@ def test_release(release, version, state, logdir):
 
 	# CHECK (installcheck)
 
-	# we need to protect this because of excessively long / hanging checks
-	killer = TimeoutKiller()
-	killer.start()
-
 	log_fname = '%(dir)s/%(release)s-%(version)s-check.log' % {'dir' : logdir, 'release' : release, 'version' : version}
 
-	(r, logtext, duration) = run_command(['pgxnclient', 'check', '-U', 'postgres', state_opt, '%(release)s=%(version)s' % {'release' : release, 'version' : version}], log_fname)
+	# pgxnclient copies regression.diffs of a failed check into the working directory
+	workdir = tempfile.mkdtemp(prefix='check-', dir=(env or os.environ).get('TMPDIR'))
+
+	try:
+
+		# we need to protect this because of excessively long / hanging checks
+		with span('check', distribution=release, version=version) as attrs:
+			(r, logtext, duration, hang, usage) = run_command(['pgxnclient', 'check', '-U', 'postgres', state_opt, spec], log_fname, env=env, log_limit=log_limit, timeout=timeouts['check'], pidfile=pidfile, cwd=workdir)
+			attrs['retval'] = r
 
-	# we're done, stop the timer
-	killer.stop()
+		# the diff is streamed (and truncated), it may be huge
+		diff = None
+		if r != 0:
+			diff = find_diff(workdir, logtext)
+
+		if diff is not None:
+			(result['check_diff'], result['check_diff_summary']) = collect_diff(diff, limit=diff_limit)
+
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	result['timeout'] = (hang is not None)
+	result['diagnostics'] = (hang or {})
 
 	result['check_log'] = logtext
+	result['resources']['check'] = usage
 	result['check_duration'] = duration
 
 	# check may fail for various reasons - there may be no 'installcheck' rule in makefile (then it's futile to search for
@@ -254,18 +526,6 @@ def test_release(release, version, state, logdir):
 		elif result['check_log'].find("Nothing to be done for `installcheck'") >= 0:
 			result['check'] = 'missing'
 		else:
-			# find the diff file
-			res = re.search('"([^"]*.diffs)"', result['check_log'])
-			if res:
-				try:
-					with codecs.open(res.group(1), 'r', encoding='utf-8') as diff:
-						result['check_diff'] = diff.read()
-				except UnicodeDecodeError as ex:
-					# unicode did not work, let's try 'ascii'
-					with codecs.open(res.group(1), 'r') as diff:
-						result['check_diff'] = diff.read()
-					result['check_diff'] += "\nERROR: " + str(ex)
-
 			result['check'] = 'error'
 			return result
 	else:
@@ -306,19 +566,14 @@ def init_logging(debug=False):
 	if debug:
 		level=logging.DEBUG
 
-	logging.basicConfig(level=level, format='%(asctime)-15s %(levelname)s %(message)s')
+	logging.basicConfig(level=level, format='%(asctime)-15s %(levelname)s [%(threadName)s] %(message)s')
 
 def encode_data(data):
 	return base64.b64encode(data.decode('utf-8', 'ignore').encode('utf-8', 'ignore'))
 
 
-def get_pg_version(datadir, logdir, default_version = '9.4.0'):
-
-	# only create the wrapper, so that we can call pg_config (to get the version - don't do inidb/start)
-	cluster = PgCluster(datadir=args.datadir, logdir=args.logdir)
-
-	# output from pg_config (as a dictionary)
-	pginfo = cluster.info()
+def get_pg_version(pginfo, default_version = '9.4.0'):
+	'version of the installation (raw string and SemVer) from the pg_config output'
 
 	# get the version number only
 	pgversion = SemVer(default_version)
@@ -328,12 +583,495 @@ def get_pg_version(datadir, logdir, default_version = '9.4.0'):
 	except:
 		pass
 
-	return (pgversion_raw, pgversion, pginfo)
+	return (pgversion_raw, pgversion)
 
 
-if __name__ == '__main__':
+def get_installation(path, args, probes):
+	'''describes the PostgreSQL installation (pg_config path or bin directory, None means PATH) - the version, pg_config
+	output, environment (compiler, pgxnclient version, ...) and log directory (per-version subdirectory when testing
+	multiple installations)'''
+
+	bindir = None
+
+	if path is not None:
+		bindir = path
+		if not os.path.isdir(path):
+			bindir = os.path.dirname(path)
+		bindir = os.path.abspath(bindir)
+
+	env = dict(os.environ)
+
+	if bindir is not None:
+		env['PATH'] = os.pathsep.join([bindir, env.get('PATH', '')])
+
+	# pg_config output and environment (cached, probed again only when the binaries change)
+	(pginfo, environment) = probes.probe(env)
+
+	(pgversion_raw, pgversion) = get_pg_version(pginfo)
+
+	logdir = args.logdir
+
+	if args.pgconfig is not None and len(args.pgconfig) > 1:
+		logdir = os.path.join(args.logdir, pgversion_raw)
+		if not os.path.isdir(logdir):
+			os.makedirs(logdir)
+
+	logging.info("PostgreSQL %(version)s (bindir '%(bindir)s')" % {'version' : pgversion_raw, 'bindir' : pginfo['BINDIR']})
+
+	installation = {'bindir' : bindir, 'pgversion_raw' : pgversion_raw, 'pgversion' : pgversion, 'pginfo' : pginfo, 'environment' : environment, 'logdir' : logdir}
+
+	# what the installation provides (for checking the prerequisities)
+	installation['facts'] = prereqs.installation_facts(installation)
+
+	return installation
+
+
+def worker_slots(args):
+	'''resources (data directory, port, socket directory, database, log directory, tmp directory) for each worker, so that
+	the parallel workers never collide'''
+
+	# single worker - keep the defaults (data directory, port, socket directory etc.)
+	if args.jobs <= 1:
+		return [{'id' : 0, 'datadir' : args.datadir, 'logdir' : args.logdir, 'port' : args.port, 'socketdir' : None, 'dbname' : 'pgxntest', 'env' : dict(os.environ)}]
+
+	slots = []
+	base_port = args.port or 5432
+
+	for i in range(args.jobs):
+
+		logdir = os.path.join(args.logdir, 'worker-%(id)d' % {'id' : i})
+		tmpdir = os.path.abspath(os.path.join(tempfile.gettempdir(), 'worker-%(id)d' % {'id' : i}))
+		socketdir = os.path.join(tmpdir, 'socket')
+
+		for d in [logdir, socketdir]:
+			if not os.path.isdir(d):
+				os.makedirs(d)
+
+		# pgxnclient downloads / builds the distributions in TMPDIR
+		env = dict(os.environ)
+		env['TMPDIR'] = tmpdir
+
+		slots.append({'id' : i, 'datadir' : ('%(dir)s-%(id)d' % {'dir' : args.datadir.rstrip('/'), 'id' : i}), 'logdir' : logdir,
+					  'port' : (base_port + i), 'socketdir' : socketdir, 'dbname' : ('pgxntest%(id)d' % {'id' : i}), 'env' : env})
+
+	return slots
+
+
+def distribution_prereqs(name, version, installation, downloads):
+	'''prerequisities of the distribution version from META.json in the archive (the tester API lists just PostgreSQL
+	versions), or None - the archive is downloaded ahead of the test, which then uses the cached one'''
+
+	if isinstance(version['prereqs'], dict):
+		return version['prereqs']
+
+	log_fname = '%(dir)s/%(name)s-%(version)s-download.log' % {'dir' : installation['logdir'], 'name' : name, 'version' : version['version']}
+
+	with span('download', distribution=name, version=version['version']):
+		archive = downloads.fetch(name, version['version'], ('--%(state)s' % {'state' : version['status']}), log_fname)
+
+	if archive is None:
+		return None
+
+	return prereqs.read_meta(archive)
+
+
+def resolve_distribution(dist, installation, args, api, templates, downloads):
+	'''fetches details about the queued distribution, and decides whether to test it at all - returns the task for the
+	test queue (with the details and dependencies), or None when the distribution should be skipped'''
+
+	tested = installation['tested']
+
+	# see if this version was already tested on this machine / postgresql version, and if yes then skip it (before any
+	# API request, the queue entry has the version too)
+	if (dist['name'], dist['version']) in tested:
+		logging.info("skipping '%(name)s-%(version)s' - already tested" % {'name' : dist['name'], 'version' : dist['version']})
+		return None
+
+	# get more details about the for the version
+	version = get_distribution_details(api, templates, dist['name'], dist['version'])
+
+	# the version in the details may be spelled differently than in the queue
+	if (dist['name'], version['version']) in tested:
+		logging.info("skipping '%(name)s-%(version)s' (%(status)s) - already tested" % {'name' : dist['name'], 'version' : version['version'], 'status' : version['status']})
+		return None
+
+	# run the build only if the prerequisities are OK
+	reason = prereqs.check(version['prereqs'], installation)
+	if reason is not None:
+		logging.info("%(dist)s-%(version)s skipped - %(reason)s (needs %(prereqs)s)" % {'dist' : dist['name'], 'version' : version['version'], 'prereqs' : version['prereqs'], 'reason' : reason})
+		return None
+
+	task = {'name' : dist['name'], 'version' : dist['version'], 'details' : version, 'installation' : installation, 'requires' : [], 'dependencies' : [], 'group' : None}
+
+	# other extensions (and platforms) the distribution requires
+	meta = distribution_prereqs(dist['name'], version, installation, downloads)
+
+	if meta is None:
+		return task
+
+	reason = prereqs.check(meta, installation)
+	if reason is not None:
+		logging.info("%(dist)s-%(version)s skipped - %(reason)s (META.json)" % {'dist' : dist['name'], 'version' : version['version'], 'reason' : reason})
+		return None
+
+	task['requires'] = prereqs.required(meta)
+	task['dependencies'] = prereqs.dependencies(meta, installation)
+
+	# distributions sharing dependencies get tested together (see TaskQueue)
+	if task['dependencies']:
+		task['group'] = (installation['pginfo']['BINDIR'], tuple([name for (name, spec) in task['dependencies']]))
+
+	return task
+
+
+class PrefetchWorker(threading.Thread):
+	'''resolves the queued distributions (details, already tested, prerequisities, dependencies) ahead of the test workers,
+	and hands the ones that need testing to the test queue - the number of prefetch threads limits the number of in-flight
+	API requests'''
+
+	def __init__(self, pending, queue, wait=False, **kwargs):
+		super(PrefetchWorker, self).__init__()
+		self.daemon = True
+		self._pending = pending
+		self._queue = queue
+		self._wait = wait
+		self._kwargs = kwargs
+
+	def run(self):
+
+		while True:
+
+			# in daemon mode, wait for new distributions (until getting None)
+			if self._wait:
+				item = self._pending.get()
+				if item is None:
+					return
+				(dist, installation) = item
+			else:
+				try:
+					(dist, installation) = self._pending.get_nowait()
+				except Queue.Empty:
+					return
+
+			try:
+				task = resolve_distribution(dist, installation, **self._kwargs)
+				if task is not None:
+					self._queue.put(task)
+			except Exception as ex:
+				logging.error("failed to fetch details for '%(name)s-%(version)s': %(msg)s" % {'name' : dist['name'], 'version' : dist['version'], 'msg' : str(ex)})
+				forget_distribution(dist['name'], dist['version'], installation)
+
+
+class QueuePoller(threading.Thread):
+	'''daemon mode - polls the queues for new distributions (every few seconds), and periodically persists the state that
+	would otherwise be saved only at exit (tested distributions, test stats)'''
+
+	def __init__(self, pending, installations, stats, args, api, templates):
+		super(QueuePoller, self).__init__(name='poller')
+		self.daemon = True
+		self._pending = pending
+		self._installations = installations
+		self._stats = stats
+		self._args = args
+		self._api = api
+		self._templates = templates
+		self._stopped = threading.Event()
+
+	def run(self):
+
+		while not self._stopped.wait(self._args.poll_interval):
+
+			try:
+				with span('poll'):
+					enqueue_distributions(self._pending, self._api, self._templates, self._installations, self._args)
+
+				for installation in self._installations:
+					installation['tested'].save()
+
+				self._stats.save()
+
+			except Exception as ex:
+				logging.error("polling the queue failed: %(msg)s" % {'msg' : str(ex)})
+
+	def stop(self):
+
+		self._stopped.set()
+		self.join()
+
+
+def test_distribution(dist, slot, args, sender, downloads, stats):
+	'''tests a single distribution (from the queue) on the worker slot, and posts the result'''
+
+	version = dist['details']
+	installation = dist['installation']
+	pgversion = installation['pgversion']
+
+	logging.info("testing '%(name)s-%(version)s' (%(status)s) on PostgreSQL %(pgversion)s" % {'name' : dist['name'], 'version' : version['version'], 'status' : version['status'], 'pgversion' : pgversion})
 
 	cluster = None
+	result = None
+	spooled = False
+
+	try:
+
+		# dependencies shared by the group of distributions, installed only by the first test needing them (that does not
+		# need a cluster) - testing without them would report the missing dependency as the distribution's own failure
+		env = dict(slot['env'])
+		if installation['bindir'] is not None:
+			env['PATH'] = os.pathsep.join([installation['bindir'], env.get('PATH', '')])
+
+		missing = [spec for (name, spec) in dist['dependencies'] if not install_dependency(name, spec, installation, env, log_limit=args.log_limit, timeout=args.max_timeout)]
+
+		if missing:
+			logging.warning("skipping '%(name)s-%(version)s' - failed to install dependencies %(deps)s" % {'name' : dist['name'], 'version' : version['version'], 'deps' : ', '.join(missing)})
+			return
+
+		# start the cluster (or reuse the warm one) and do the testing
+		cluster = acquire_cluster(slot, args, installation)
+
+		logging.info("PostgreSQL cluster started, version = %(version)s" % {'version' : pgversion})
+
+		# run the actual test
+		# timeouts derived from the history of the distribution
+		timeouts = dict([(phase, stats.timeout(dist['name'], phase, args.timeout, args.timeout_factor, args.max_timeout)) for phase in ['install', 'load', 'check']])
+
+		# CREATE EXTENSION (IF NOT EXISTS) is available since 9.1
+		extensions = []
+		if pgversion >= SemVer('9.1.0'):
+			extensions = dist['requires']
+
+		result = test_release(dist['name'], version['version'], version['status'], logdir=installation['logdir'], downloads=downloads, env=cluster.env(slot['env']), dbname=slot['dbname'], log_limit=args.log_limit,
+							  artifacts=installation['artifacts'], fingerprint=installation['fingerprint'], timeouts=timeouts, pidfile=cluster.pidfile(), diff_limit=args.diff_limit, extensions=extensions)
+
+		# the timeout flag is used only to decide whether to rebuild the cluster, not sent to the server
+		slot['timeout'] = result.pop('timeout')
+
+		# durations / timeouts for scheduling of the future runs
+		stats.record(dist['name'], result, timeout=slot['timeout'])
+
+		if slot['timeout']:
+			outcome = 'timeout'
+		elif 'error' in [result['install'], result['load'], result['check']]:
+			outcome = 'error'
+		else:
+			outcome = 'ok'
+
+		metrics.inc('pgxn_tester_tests_total', {'result' : outcome})
+
+		# additional info, and a random UUID for the result (we're generating it here as a protection against simple replay attacks)
+		result.update({'uuid' : str(uuid.uuid4()), 'machine' : args.name, 'config' : json.dumps(dict(installation['pginfo'], PROFILE=slot['profile'])), 'env' : json.dumps(installation['environment'])})
+
+		# diagnostics of a timed-out phase (processes, backtraces, pg_stat_activity)
+		result['diagnostics'] = json.dumps(result['diagnostics'])
+
+		# resource usage of the phases, also kept locally (the metrics file in the log directory)
+		record_metrics(os.path.join(args.logdir, 'metrics.jsonl'), {'distribution' : dist['name'], 'version' : version['version'], 'pgversion' : pgversion, 'machine' : args.name,
+									'time' : int(time.time()), 'timeout' : slot['timeout'], 'resources' : result['resources'],
+									'durations' : dict([(phase, result[phase + '_duration']) for phase in ['install', 'load', 'check']])})
+
+		result['resources'] = json.dumps(result['resources'])
+
+		# the logs are encoded straight from the log files (phases that did not run have empty logs)
+		for k in ['install_log', 'load_log', 'check_log']:
+			if isinstance(result[k], CapturedLog):
+				result[k] = result[k].encode()
+
+		result['check_diff'] = base64.b64encode(result['check_diff'].encode('utf-8'))
+
+		# failed tests and number of hunks (complete, even if the diff got truncated)
+		result['check_diff_summary'] = json.dumps(result['check_diff_summary'])
+
+		# sign the request with the shared secret
+		result = sign_request(result, args.secret)
+
+		# spool the result, the sender thread submits it in the background
+		sender.submit(result)
+		spooled = True
+
+	except Exception as ex:
+
+		logging.info("testing failed: %(msg)s" % {'msg' : str(ex)})
+		logging.exception(ex)
+
+	finally:
+
+		# stop the PostgreSQL cluster and remove the data directory (unless we can keep it warm)
+		if cluster:
+			release_cluster(slot, args, failed=(result is None))
+
+		# try again later (with the next poll in daemon mode)
+		if not spooled:
+			forget_distribution(dist['name'], dist['version'], installation)
+
+
+# postgresql.conf overrides of the "fast" profile (none of this matters for throwaway test clusters)
+FAST_SETTINGS = {'fsync' : 'off', 'synchronous_commit' : 'off', 'full_page_writes' : 'off'}
+
+def cluster_profile(slot, args):
+	'''data directory and settings of the cluster for the worker slot, according to the profile - the "fast" profile
+	places the data directory on tmpfs (if there's enough free space and memory) and disables durability'''
+
+	if args.profile != 'fast':
+		return (slot['datadir'], {}, False)
+
+	settings = dict(FAST_SETTINGS)
+
+	# a quarter of the memory, shared by all the workers (but never more than 128MB)
+	memory = psutil.virtual_memory()
+	settings['shared_buffers'] = '%(size)dMB' % {'size' : max(16, min(128, memory.total / (4 * 1024 * 1024 * max(args.jobs, 1))))}
+
+	required = args.tmpfs_min * 1024 * 1024
+
+	if os.path.isdir(args.tmpfs_dir):
+		st = os.statvfs(args.tmpfs_dir)
+		if (st.f_bavail * st.f_frsize >= required) and (memory.available >= required):
+			datadir = os.path.join(args.tmpfs_dir, 'pgxn-tester-%(pid)d-%(id)d' % {'pid' : os.getpid(), 'id' : slot['id']})
+			return (datadir, settings, True)
+
+	logging.info("not enough memory for data directory on tmpfs, using '%(dir)s'" % {'dir' : slot['datadir']})
+
+	return (slot['datadir'], settings, False)
+
+
+def acquire_cluster(slot, args, installation):
+	'returns a running cluster of the installation for the worker slot (the warm cluster, if there is one)'
+
+	if slot.get('cluster') is not None:
+
+		if slot['installation'] is installation:
+			return slot['cluster']
+
+		# warm cluster of a different PostgreSQL version
+		release_cluster(slot, args, force=True)
+
+	(datadir, settings, tmpfs) = cluster_profile(slot, args)
+
+	# only create the wrapper, so that we can call pg_config (to get the version - don't do inidb/start)
+	cluster = PgCluster(datadir=datadir, logdir=slot['logdir'], port=slot['port'], socketdir=slot['socketdir'], templatedir=args.templatedir, bindir=installation['bindir'], settings=settings, pginfo=installation['pginfo'])
+
+	# the profile is submitted with the results (as part of the config)
+	profile = {'name' : args.profile, 'tmpfs' : tmpfs, 'settings' : cluster.settings()}
+
+	snapshot = None
+
+	try:
+
+		cluster.start()
+
+		# remember state of template1, so that we can detect objects left there by the tests
+		if args.warm:
+			snapshot = cluster.snapshot()
+
+		log_position = cluster.log_position()
+
+	except:
+
+		# don't leave a half-initialized cluster behind (the next test would get it as a warm one)
+		try:
+			cluster.terminate()
+		except Exception as ex:
+			logging.error("failed to remove the cluster: %(msg)s" % {'msg' : str(ex)})
+
+		raise
+
+	# only a cluster that is actually running gets into the slot
+	slot.update({'cluster' : cluster, 'installation' : installation, 'tests' : 0, 'timeout' : False, 'profile' : profile,
+				 'snapshot' : snapshot, 'log_position' : log_position})
+
+	return cluster
+
+
+def cluster_broken(slot, args):
+	'checks whether the last test left the warm cluster in a bad state (returns the reason, or None if the cluster is OK)'
+
+	cluster = slot['cluster']
+
+	if slot['timeout']:
+		return 'check timed out'
+
+	if not cluster.running():
+		return 'cluster is not running'
+
+	if cluster.crashed(slot['log_position']):
+		return 'crash in the server log'
+
+	if cluster.snapshot() != slot['snapshot']:
+		return 'objects left in template1'
+
+	if slot['tests'] >= args.rebuild:
+		return ('%(tests)d tests on the cluster' % {'tests' : slot['tests']})
+
+	return None
+
+
+def release_cluster(slot, args, failed=False, force=False):
+	'''stops the cluster and removes the data directory, unless running with a warm cluster (in that case the cluster is
+	rebuilt only when the test broke it, or after enough tests)'''
+
+	cluster = slot.get('cluster')
+
+	if cluster is None:
+		return
+
+	slot['tests'] += 1
+
+	reason = 'test failed'
+
+	if force:
+		reason = 'forced'
+	elif not args.warm:
+		reason = 'warm cluster not enabled'
+	elif not failed:
+		try:
+			reason = cluster_broken(slot, args)
+		except Exception as ex:
+			reason = str(ex)
+
+	if reason is None:
+		slot['log_position'] = cluster.log_position()
+		return
+
+	logging.info("removing DATA directory (%(reason)s)" % {'reason' : reason})
+
+	slot['cluster'] = None
+	cluster.terminate()
+
+
+class TestWorker(threading.Thread):
+	'worker thread, testing distributions from the shared queue on its own cluster (see worker_slots)'
+
+	def __init__(self, queue, slot, **kwargs):
+		super(TestWorker, self).__init__(name=('worker-%(id)d' % {'id' : slot['id']}))
+		self._queue = queue
+		self._slot = slot
+		self._kwargs = kwargs
+
+	def run(self):
+
+		while True:
+
+			# keep testing distributions with the same dependencies (if there are any left)
+			dist = self._queue.get(group=self._slot.get('group'))
+
+			# queue drained, we're done
+			if dist is None:
+				break
+
+			self._slot['group'] = dist['group']
+
+			try:
+				test_distribution(dist, self._slot, **self._kwargs)
+			except Exception as ex:
+				logging.info("testing failed: %(msg)s" % {'msg' : str(ex)})
+				logging.exception(ex)
+			finally:
+				self._queue.done(dist)
+
+		# stop the warm cluster (if any)
+		release_cluster(self._slot, self._kwargs['args'], force=True)
+
+
+if __name__ == '__main__':
 
 	# parse arguments first
 	args = parse_cmdline()
@@ -349,95 +1087,149 @@ if __name__ == '__main__':
 
 	logging.info("using API host='%(host)s' prefix='%(prefix)s'" % {'host' : api_host, 'prefix' : api_prefix})
 
+	if args.trace is not None:
+		configure_trace(args.trace, args.trace_format)
+
+	# shared by all the threads (prefetch, workers)
+	api = ApiClient(api_host, compress=(not args.no_compress))
+
+	server = None
+
 	# do this in try/except block, so that we can stop the cluster in case of failure
 	try:
 
 		# now get URI templates (this should query actual packages)
-		templates = get_uri_templates(api_host, api_prefix)
+		templates = get_uri_templates(api, api_prefix)
 
-		# get version of the PostgreSQL cluster
-		(pgversion_raw, pgversion, pginfo) = get_pg_version(datadir=args.datadir, logdir=args.logdir)
+		# PostgreSQL installations to test (pg_config in PATH by default)
+		probes = EnvironmentCache(os.path.join(args.cachedir, 'environment.json'))
+		installations = [get_installation(path, args, probes) for path in (args.pgconfig or [None])]
+		probes.save()
 
-		# get queue of all distribution versions for this machine
-		distributions = get_distributions(api_host, templates, args.name, pgversion)
+		# archives downloaded from PGXN (shared by all PostgreSQL versions)
+		downloads = DownloadCache(os.path.join(args.cachedir, 'downloads'))
 
-		logging.info("received list of %(len)d distributions to test on %(name)s" % {'len' : len(distributions), 'name' : args.name})
+		# cache of built distributions (disabled by default), shared by all the installations (keyed by their fingerprint)
+		artifacts = None
+		if args.artifact_cache_size > 0:
+			artifacts = ArtifactCache(os.path.join(args.cachedir, 'builds'), args.artifact_cache_size * 1024 * 1024)
 
-		# loop through the distributions
-		for dist in distributions:
+		for installation in installations:
 
-			# check if testing only a specified distribution (supplied but not matching => skip to next)
-			if args.distribution is not None and args.distribution != dist['name']:
-				continue
+			installation['artifacts'] = artifacts
+			installation['fingerprint'] = fingerprint(installation['pginfo'], installation['environment']['compiler'])
 
-			# check if testing only a specified distribution version (supplied but not matching => skip to next)
-			if (args.distribution is not None) and (args.version is not None) and (args.version != dist['version']):
-				continue
+			# distribution versions already tested on this machine / PostgreSQL version
+			installation['tested'] = get_tested(api, templates, args.name, installation['pgversion_raw'], args.cachedir, args.tested_ttl)
 
-			# get more details about the for the version
-			version = get_distribution_version(api_host, templates, dist['name'], dist['version'])
+		# results left over by previous runs (not submitted yet) count as tested (the spool is shared by all versions)
+		spool = ResultSpool(args.spooldir)
 
-			logging.info("testing '%(name)s-%(version)s' (%(status)s)" % {'name' : dist['name'], 'version' : version['version'], 'status' : version['status']})
+		for fname in spool.pending():
+			result = spool.load(fname)
+			installation = installation_for(result, installations)
+			if installation is not None:
+				installation['tested'].add(result['distribution'], result['version'])
 
-			# see if this version was already tested on this machine / postgresql version, and if yes then skip it
-			if already_tested_on(api_host, templates, machine=args.name, pgversion=pgversion_raw, distribution=dist['name'], version=version['version']):
-				logging.info("skipping '%(name)s-%(version)s' (%(status)s) - already tested" % {'name' : dist['name'], 'version' : version['version'], 'status' : version['status']})
-				continue
+		# submits the results in the background (starting with results left over by previous runs)
+		sender = ResultSender(spool, lambda result: submit_result(result, api, templates, installations))
+		sender.start()
 
-			# run the build only if the prerequisities are OK
-			if check_prerequisities(pgversion, version['prereqs']):
-				
-				# only create the wrapper, so that we can call pg_config (to get the version - don't do inidb/start)
-				cluster = PgCluster(datadir=args.datadir, logdir=args.logdir)
+		# history of the tests (durations, timeouts), to schedule the longest tests first and the hanging ones last
+		stats = TestStats(os.path.join(args.cachedir, 'stats.json'))
 
-				try:
+		# versions of the same distribution install into the same PostgreSQL installation, so don't test them concurrently
+		# (and batch the distributions sharing dependencies, installed once per installation)
+		queue = TaskQueue(key=lambda dist: (dist['installation']['pginfo']['BINDIR'], dist['name']), priority=lambda dist: stats.priority(dist['name']), group=lambda dist: dist['group'])
 
-					# start the cluster and do the testing
-					cluster.start()
+		# (distribution, installation) pairs waiting for the prefetch (details, already tested, prerequisities)
+		pending = Queue.Queue()
 
-					logging.info("PostgreSQL cluster started, version = %(version)s" % {'version' : pgversion})
+		metrics.gauge('pgxn_tester_queue_pending', pending.qsize)
+		metrics.gauge('pgxn_tester_queue_ready', lambda: len(queue))
+		metrics.gauge('pgxn_tester_tests_per_hour', lambda: round(3600 * metrics.total('pgxn_tester_tests_total') / max(metrics.uptime(), 1), 1))
 
-					# run the actual test
-					result = test_release(dist['name'], version['version'], version['status'], logdir=args.logdir)
+		if args.metrics_port is not None:
+			server = MetricsServer(metrics, args.metrics_port)
+			server.start()
 
-					# additional info, and a random UUID for the result (we're generating it here as a protection against simple replay attacks)
-					result.update({'uuid' : str(uuid.uuid4()), 'machine' : args.name, 'config' : json.dumps(pginfo), 'env' : json.dumps({})})
+		# the whole queue on the first request, only the newly added distributions on the following ones (daemon mode)
+		enqueue_distributions(pending, api, templates, installations, args)
 
-					# there has to be a better way ... but well, this seems to work for now
-					result['install_log'] = base64.b64encode(result['install_log'].encode('utf-8'))
-					result['load_log'] = base64.b64encode(result['load_log'].encode('utf-8'))
-					result['check_log'] = base64.b64encode(result['check_log'].encode('utf-8'))
-					result['check_diff'] = base64.b64encode(result['check_diff'].encode('utf-8'))
+		logging.info("testing %(len)d distributions using %(jobs)d worker(s)" % {'len' : pending.qsize(), 'jobs' : max(args.jobs, 1)})
 
-					# sign the request with the shared secret
-					result = sign_request(result, args.secret)
+		# the test workers start as soon as the first distribution gets resolved
+		prefetchers = [PrefetchWorker(pending, queue, wait=args.daemon, args=args, api=api, templates=templates, downloads=downloads) for i in range(max(args.prefetch, 1))]
+		workers = [TestWorker(queue, slot, args=args, sender=sender, downloads=downloads, stats=stats) for slot in worker_slots(args)]
 
-					# do the POST request (if OK, status is 200)
-					(status, reason) = post_results(api_host, templates, result)
+		for thread in (prefetchers + workers):
+			thread.start()
 
-					if (status == 200):
-						logging.info("POST OK : UUID='%(uuid)s' install=%(install)s load=%(load)s check=%(check)s" % {'uuid' : reason['uuid'], 'install' : result['install'], 'load' : result['load'], 'check' : result['check']})
-					else:
-						logging.error(reason)
-						logging.error("POST for %(dist)s-%(version)s failed (status = %(status)d)" % {'dist' : dist['name'], 'version' : version['version'], 'status' : status})
+		if args.daemon:
 
-				except Exception as ex:
+			stop = threading.Event()
 
-					logging.info("testing failed: %(msg)s" % {'msg' : str(ex)})
-					logging.exception(ex)
+			def shutdown(signum, frame):
+				logging.info("received signal %(signum)d, shutting down" % {'signum' : signum})
+				stop.set()
 
-				finally:
+			signal.signal(signal.SIGTERM, shutdown)
+			signal.signal(signal.SIGINT, shutdown)
 
-					# stop the PostgreSQL cluster and remove the data directory
-					if cluster:
-						logging.info("removing DATA directory")
-						cluster.terminate()
+			poller = QueuePoller(pending, installations, stats, args, api, templates)
+			poller.start()
 
-			else:
+			# wait with a timeout, otherwise the signals would not get delivered
+			while not stop.is_set():
+				stop.wait(1)
+
+			poller.stop()
+
+			# drop the distributions not resolved yet, and stop the prefetchers
+			try:
+				while True:
+					pending.get_nowait()
+			except Queue.Empty:
+				pass
+
+			for prefetcher in prefetchers:
+				pending.put(None)
+
+			for prefetcher in prefetchers:
+				prefetcher.join()
+
+			# finish the running tests, but don't start the queued ones
+			queue.close(discard=True)
 
-				logging.info("%(dist)s-%(version)s skipped - unmet PostgreSQL version (current %(pgversion)s, needs %(prereqs)s)" % {'dist' : dist['name'], 'version' : version['version'], 'prereqs' : version['prereqs'], 'pgversion' : pgversion})
+		else:
+
+			# once everything is resolved, the workers may terminate after draining the queue
+			for prefetcher in prefetchers:
+				prefetcher.join()
+
+			queue.close()
+
+		for worker in workers:
+			worker.join()
+
+		# submit the remaining results (or leave them spooled for the next run)
+		sender.stop()
 
+		# remember what we tested in this run (and how long it took)
+		for installation in installations:
+			installation['tested'].save()
+
+		stats.save()
 
 	except Exception as ex:
 		logging.info("testing failed: %(msg)s" % {'msg' : str(ex)})
 		logging.exception(ex)
+
+	finally:
+		api.log_stats()
+		api.close()
+
+		if server is not None:
+			server.stop()
+
+		close_trace()
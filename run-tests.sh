@@ -18,10 +18,20 @@ LANG="C"
 PGDIR="$DIR/pg"
 TMPDIR="$DIR/tmp"
 
+# number of distributions tested in parallel (all versions share the worker pool)
+JOBS=`cat /proc/cpuinfo  | grep 'processor' | wc -l`
+
 # by default we'll return 0 (everything OK)
 retval=0
 
-# loop through the PostgreSQL versions
+# versions built by prepare-releases.py (it registers pg_config of each installation), if available
+if [ -f "$PGDIR/installations" ]; then
+	VERSIONS=`cat $PGDIR/installations | xargs -n 1 dirname | xargs -n 1 dirname | xargs -n 1 basename`
+fi
+
+# PostgreSQL installations to test (only those that are available)
+PGCONFIGS=""
+
 for version in $VERSIONS; do
 
 	if [ ! -d "$PGDIR/$version" ]; then
@@ -31,25 +41,31 @@ for version in $VERSIONS; do
 
 	else
 
-		echo "running tests on PostgreSQL $version"
+		PGCONFIGS="$PGCONFIGS --pg-config $PGDIR/$version/bin/pg_config"
+
+	fi
+
+done
 
-		# make the 'tmp' directory
-		mkdir -p $TMPDIR
+if [ "$PGCONFIGS" != "" ]; then
 
-		# run the tests
-		TMPDIR=$TMPDIR PATH="$PGDIR/$version/bin:$PATH" LANG=$LANG ./run-tests.py --name "$NAME" --secret "$SECRET" >> $DIR/logs/test-$version.log 2>&1
+	echo "running tests on PostgreSQL $VERSIONS"
 
-		if [ "$?" != "0" ]; then
-			echo "ERROR: running tests on PostgreSQL $version failed (retval=$?)"
-			retval=1
-		fi
+	# make the 'tmp' directory
+	mkdir -p $TMPDIR
 
-		# remove the 'tmp' directory (files left over by pgxnclient)
-		rm -Rf $TMPDIR
+	# run the tests on all the versions at once (sharing the queue, caches and result uploads)
+	TMPDIR=$TMPDIR LANG=$LANG ./run-tests.py --name "$NAME" --secret "$SECRET" --jobs $JOBS $PGCONFIGS >> $DIR/logs/test.log 2>&1
 
+	if [ "$?" != "0" ]; then
+		echo "ERROR: running tests failed (retval=$?)"
+		retval=1
 	fi
 
-done
+	# remove the 'tmp' directory (files left over by pgxnclient)
+	rm -Rf $TMPDIR
+
+fi
 
 # 0 - everything OK, 1 - missing PostgreSQL build or error when running the tests
 exit $retval